@@ -0,0 +1,220 @@
+"""Offline benchmarks for the app's own overhead.
+
+Starts a local stub SPARQL endpoint serving the synthetic data set in
+bench/fixtures.py, then times each processing stage separately for a set of
+representative resources, as well as the complete Flask routes. Results are
+written as JSON so that runs on different commits can be compared:
+
+    python -m bench.benchmark --output before.json
+    ... switch commits ...
+    python -m bench.benchmark --output after.json
+    python -m bench.benchmark --compare before.json after.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from flask import render_template
+from rdflib import Graph
+
+from biblodui import app, model, views
+from biblodui.cache import GraphCache
+from biblodui.endpoint import SPARQLClient, TURTLE, NTRIPLES
+from biblodui.ntparser import parse_ntriples
+from biblodui.triplestore import GraphBuilder
+from biblodui.rendercache import RenderCache
+from biblodui.viewmodel import build_view
+
+from bench import fixtures
+from bench.stub_endpoint import StubEndpoint
+
+SERIALIZE_FORMATS = ('turtle', 'nt', 'xml', 'json-ld')
+STREAM_FORMATS = ('turtle', 'nt')
+ROUTE_SUFFIXES = ('', '.ttl', '.nt', '.rdf', '.json')
+
+
+def measure(func, repeat):
+    """call func once to warm up, then repeat times; return timings in ms and the last result"""
+    result = func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    stats = {'min_ms': round(min(timings), 3),
+             'median_ms': round(statistics.median(timings), 3),
+             'mean_ms': round(statistics.mean(timings), 3)}
+    return stats, result
+
+
+def query_all(queries, accept):
+    """run the queries one after another, returning the response bodies"""
+    return [model.sparql.query(query, accept) for query in queries]
+
+
+def parse_turtle(bodies):
+    graph = Graph()
+    for data in bodies:
+        graph.parse(data=data.decode('utf-8'), format='turtle')
+    return graph
+
+
+def parse_ntriples_rdflib(bodies):
+    graph = Graph()
+    for data in bodies:
+        graph.parse(data=data.decode('utf-8'), format='nt')
+    return graph
+
+
+def parse_ntriples_fast(bodies, graph):
+    for data in bodies:
+        parse_ntriples(data, graph)
+    return graph
+
+
+def walk_model(res):
+    """build everything resource.html needs from the model"""
+    view = build_view(res)
+    for works in view.work_lists.values():
+        works.works()
+    return view
+
+
+def bench_resource(client, uri, route, repeat):
+    stages = {}
+    cls = type(model.get_resource(str(uri), Graph()))
+    queries = [cls(uri, Graph()).construct_query(query) for name, query, required in cls.subqueries]
+
+    # the subqueries of the page graph one after another
+    stages['query'], data = measure(lambda: query_all(queries, TURTLE), repeat)
+    stages['parse'], graph = measure(lambda: parse_turtle(data), repeat)
+    # the same graph as N-Triples, with rdflib's parser and the fast one, the
+    # latter into an rdflib Graph and into a compact graph as the app does it
+    stages['query.nt'], ntdata = measure(lambda: query_all(queries, NTRIPLES), repeat)
+    stages['parse.nt'], _ = measure(lambda: parse_ntriples_rdflib(ntdata), repeat)
+    stages['parse.nt.fast'], _ = measure(lambda: parse_ntriples_fast(ntdata, Graph()), repeat)
+    stages['parse.nt.compact'], graph = measure(lambda: parse_ntriples_fast(ntdata, GraphBuilder()).build(),
+                                                repeat)
+    # the subqueries run concurrently and merged, as the app does it
+    stages['fetch'], _ = measure(lambda: cls(uri).query_endpoint(), repeat)
+    res = cls(uri, graph)
+    stages['properties'], view = measure(lambda: walk_model(res), repeat)
+    with app.test_request_context(route):
+        stages['render'], html = measure(
+            lambda: render_template('resource.html', title=view.name, view=view, res=res), repeat)
+    for fmt in SERIALIZE_FORMATS:
+        stages['serialize.%s' % fmt], _ = measure(lambda: res.serialize(fmt), repeat)
+    for fmt in STREAM_FORMATS:
+        stages['stream.%s' % fmt], _ = measure(lambda: b''.join(res.stream(fmt)), repeat)
+    sizes = {'response_bytes': sum(len(body) for body in data), 'triples': len(graph), 'html_bytes': len(html)}
+
+    for suffix in ROUTE_SUFFIXES:
+        path = route + suffix
+        stages['route%s' % (suffix or '.html')], response = measure(lambda: client.get(path), repeat)
+        if response.status_code != 200:
+            raise RuntimeError("GET %s returned %s" % (path, response.status_code))
+    for name in res.work_lists:
+        if res.work_list(name).total > 0:
+            path = '%s/%s' % (route, name)
+            stages['route.%s' % name], _ = measure(lambda: client.get(path), repeat)
+    return {'stages': stages, 'sizes': sizes}
+
+
+def bench_search(client, repeat):
+    stages = {}
+    stages['query'], search = measure(lambda: model.Search(fixtures.SEARCH_QUERY), repeat)
+    for fmt in ('html', 'xml'):
+        with app.test_request_context('/bib/search.%s' % fmt):
+            stages['render.%s' % fmt], _ = measure(
+                lambda: render_template('search.%s' % fmt, search=search,
+                                        base_url='http://localhost/bib/search.%s' % fmt,
+                                        url_root='http://localhost/'), repeat)
+        path = '/bib/search.%s?query=%s' % (fmt, fixtures.SEARCH_QUERY)
+        stages['route.%s' % fmt], _ = measure(lambda: client.get(path), repeat)
+    return {'stages': stages, 'sizes': {'results': search.total_results()}}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat, cases):
+    stub = StubEndpoint(fixtures.build_dataset())
+    model.sparql = SPARQLClient(stub.start())
+    # measure the uncached path: every route hit goes to the (stub) endpoint
+    model.graph_cache = GraphCache(maxsize=0)
+    model.list_cache = GraphCache(maxsize=0)
+    model.search_cache = GraphCache(maxsize=0)
+    model.disk_cache = None
+    views.render_cache = RenderCache(max_bytes=0)
+    client = app.test_client()
+
+    results = {}
+    try:
+        for name in cases:
+            if name == 'search':
+                results[name] = bench_search(client, repeat)
+            else:
+                uri, route = fixtures.CASES[name]
+                results[name] = bench_resource(client, uri, route, repeat)
+    finally:
+        model.sparql.close()
+        stub.stop()
+
+    return {'revision': git_revision(),
+            'python': platform.python_version(),
+            'repeat': repeat,
+            'cases': results}
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print("%-12s %-20s %12s %12s %8s" % ('case', 'stage', 'old (ms)', 'new (ms)', 'ratio'))
+    for case, result in new['cases'].items():
+        for stage, timing in result['stages'].items():
+            try:
+                before = old['cases'][case]['stages'][stage]['median_ms']
+            except KeyError:
+                continue
+            after = timing['median_ms']
+            ratio = after / before if before else float('inf')
+            print("%-12s %-20s %12.3f %12.3f %8.2f" % (case, stage, before, after, ratio))
+
+
+def main(argv=None):
+    all_cases = list(fixtures.CASES) + ['search']
+    parser = argparse.ArgumentParser(description='Benchmark the app against a local stub endpoint')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions per stage')
+    parser.add_argument('--case', action='append', choices=all_cases,
+                        help='case to run (may be repeated, default: all)')
+    parser.add_argument('--output', help='write results to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files and exit')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = run(args.repeat, args.case or all_cases)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == '__main__':
+    main()
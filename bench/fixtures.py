@@ -0,0 +1,131 @@
+"""Synthetic data set for the benchmarks, shaped like the Fennica data.
+
+The data is generated deterministically so that runs on different commits
+see exactly the same graphs.
+"""
+
+from rdflib import Graph, Literal, Namespace, URIRef, BNode, RDF
+from rdflib.namespace import SKOS, DC
+
+SCHEMA = Namespace('http://schema.org/')
+BF = Namespace('http://id.loc.gov/ontologies/bibframe/')
+BIB = Namespace('http://urn.fi/URN:NBN:fi:bib:me:')
+PN = Namespace('http://urn.fi/URN:NBN:fi:au:pn:')
+CN = Namespace('http://urn.fi/URN:NBN:fi:au:cn:')
+YSO = Namespace('http://www.yso.fi/onto/yso/')
+
+SMALL_WORK = BIB.W00000000001
+LARGE_WORK = BIB.W00000000002
+AUTHOR = PN['000000001']
+CONCEPT = YSO.p1000
+
+# representative resources: name -> (URI, route)
+CASES = {
+    'small_work': (SMALL_WORK, '/bib/me/W00000000001'),
+    'large_work': (LARGE_WORK, '/bib/me/W00000000002'),
+    'author': (AUTHOR, '/au/pn/000000001'),
+    'concept': (CONCEPT, '/yso/p1000'),
+}
+
+SEARCH_QUERY = 'novel'
+
+WORDS = ['seitsemän', 'veljestä', 'novel', 'history', 'kalevala', 'poems', 'finland',
+         'essays', 'letters', 'tales', 'journey', 'north', 'winter', 'sea', 'forest']
+
+
+def title(n):
+    return " ".join(WORDS[(n * 7 + i * 3) % len(WORDS)] for i in range(1 + n % 4)).capitalize()
+
+
+def add_person(g, uri, n):
+    g.add((uri, RDF.type, SCHEMA.Person))
+    g.add((uri, SCHEMA.name, Literal("Author %d" % n)))
+    g.add((uri, SCHEMA.birthDate, Literal(str(1800 + n % 200))))
+
+
+def add_organization(g, uri, n):
+    g.add((uri, RDF.type, SCHEMA.Organization))
+    g.add((uri, SCHEMA.name, Literal("Publisher %d" % n)))
+
+
+def add_concept(g, uri, n):
+    g.add((uri, RDF.type, SKOS.Concept))
+    g.add((uri, SKOS.prefLabel, Literal("concept %d" % n, lang='en')))
+    g.add((uri, SKOS.prefLabel, Literal("käsite %d" % n, lang='fi')))
+
+
+def add_work(g, uri, n, author, subjects):
+    g.add((uri, RDF.type, BF.Work))
+    g.add((uri, RDF.type, SCHEMA.CreativeWork))
+    g.add((uri, SCHEMA.name, Literal(title(n))))
+    g.add((uri, SCHEMA.author, author))
+    g.add((uri, SCHEMA.inLanguage, Literal('fi')))
+    for subject in subjects:
+        g.add((uri, SCHEMA.about, subject))
+
+
+def add_instance(g, uri, n, work, publisher, place):
+    g.add((uri, RDF.type, SCHEMA.Book))
+    g.add((uri, SCHEMA.name, g.value(work, SCHEMA.name)))
+    g.add((uri, SCHEMA.exampleOfWork, work))
+    g.add((work, SCHEMA.workExample, uri))
+    g.add((uri, SCHEMA.datePublished, Literal(str(1850 + n % 170))))
+    g.add((uri, SCHEMA.publisher, publisher))
+    g.add((uri, SCHEMA.numberOfPages, Literal("%d s." % (100 + n % 400))))
+    if n % 5 == 0:
+        g.add((uri, SCHEMA.bookFormat, SCHEMA.EBook))
+    ident = BNode('id%d' % n)
+    g.add((uri, SCHEMA.identifier, ident))
+    g.add((ident, RDF.type, SCHEMA.PropertyValue))
+    g.add((ident, SCHEMA.propertyID, Literal('FI-FENNI')))
+    g.add((ident, SCHEMA.value, Literal(str(100000 + n))))
+    pub = BNode('pub%d' % n)
+    g.add((uri, SCHEMA.publication, pub))
+    g.add((pub, RDF.type, SCHEMA.PublicationEvent))
+    g.add((pub, SCHEMA.location, place))
+    g.add((pub, SCHEMA.organizer, publisher))
+
+
+def build_dataset():
+    """return the whole benchmark data set as one Graph"""
+    g = Graph()
+    concepts = [YSO['p%d' % (1000 + n)] for n in range(50)]
+    for n, concept in enumerate(concepts):
+        add_concept(g, concept, n)
+    publishers = [CN['%07dA' % n] for n in range(20)]
+    for n, publisher in enumerate(publishers):
+        add_organization(g, publisher, n)
+    places = [YSO['p%d' % (2000 + n)] for n in range(10)]
+    for n, place in enumerate(places):
+        g.add((place, RDF.type, SKOS.Concept))
+        g.add((place, SCHEMA.name, Literal("Place %d" % n)))
+
+    add_person(g, AUTHOR, 1)
+    others = [PN['%09d' % n] for n in range(2, 50)]
+    for n, person in enumerate(others):
+        add_person(g, person, n + 2)
+
+    # a small work with a single instance
+    add_work(g, SMALL_WORK, 1, AUTHOR, concepts[1:3])
+    add_instance(g, BIB.I00000000001, 1, SMALL_WORK, publishers[0], places[0])
+
+    # a work with 200 instances
+    add_work(g, LARGE_WORK, 2, AUTHOR, concepts[:5])
+    for n in range(200):
+        add_instance(g, BIB['I%011d' % (1000 + n)], n, LARGE_WORK,
+                     publishers[n % len(publishers)], places[n % len(places)])
+
+    # a prolific author with 5000 authored works, 500 contributed works
+    # and 100 works about them; many of the works are about CONCEPT
+    for n in range(5000):
+        add_work(g, BIB['W%011d' % (10000 + n)], n, AUTHOR, [concepts[n % len(concepts)]])
+    for n in range(500):
+        work = BIB['W%011d' % (20000 + n)]
+        add_work(g, work, n + 7, others[n % len(others)], [concepts[n % len(concepts)]])
+        g.add((work, SCHEMA.contributor, AUTHOR))
+    for n in range(100):
+        add_work(g, BIB['W%011d' % (30000 + n)], n + 11, others[n % len(others)], [AUTHOR])
+
+    g.add((CONCEPT, RDF.type, SKOS.Concept))
+    g.add((CONCEPT, DC.title, Literal("benchmark concept", lang='en')))
+    return g
@@ -0,0 +1,116 @@
+"""Local stand-in for the SPARQL endpoint, used by the benchmarks.
+
+Queries are evaluated with rdflib against the benchmark data set the first
+time they are seen; the serialized response is recorded and replayed on
+subsequent requests, so that timings measured against the stub reflect the
+app's own overhead rather than query evaluation. Jena text queries used by
+Search are answered by simple substring matching.
+"""
+
+import gzip
+import json
+import re
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+from rdflib import RDF
+from rdflib.namespace import SKOS
+
+from bench.fixtures import SCHEMA, BF
+
+SEARCH_TYPES = (BF.Work, SCHEMA.Person, SCHEMA.Organization, SKOS.Concept)
+
+
+class StubEndpoint:
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.recorded = {} # key: (query, accept), value: (content type, body, gzipped body)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def search(self, query):
+        text_query = re.search(r"text:query \('([^']*)'\s*(\d*)\)", query)
+        words = text_query.group(1).replace('+', '').replace('*', '').lower().split()
+        limit = re.search(r'LIMIT\s+(\d+)', query)
+        offset = re.search(r'OFFSET\s+(\d+)', query)
+        hits = []
+        for uri, type_ in self.dataset.subject_objects(RDF.type):
+            if type_ not in SEARCH_TYPES:
+                continue
+            for literal in self.dataset.objects(uri, SCHEMA.name):
+                if all(word in literal.lower() for word in words):
+                    score = 1.0 / len(literal)
+                    hits.append((score, str(uri), str(literal), str(type_)))
+        hits.sort(key=lambda hit: (-hit[0], hit[1]))
+        if text_query.group(2):
+            hits = hits[:int(text_query.group(2))]
+        start = int(offset.group(1)) if offset else 0
+        end = start + int(limit.group(1)) if limit else None
+        bindings = [{'uri': {'type': 'uri', 'value': uri},
+                     'score': {'type': 'literal', 'value': str(score)},
+                     'literal': {'type': 'literal', 'value': literal},
+                     'type': {'type': 'uri', 'value': type_}}
+                    for score, uri, literal, type_ in hits[start:end]]
+        return {'head': {'vars': ['uri', 'score', 'literal', 'type']},
+                'results': {'bindings': bindings}}
+
+    def evaluate(self, query, accept):
+        if 'text:query' in query:
+            return ('application/sparql-results+json', json.dumps(self.search(query)).encode('utf-8'))
+        result = self.dataset.query(query)
+        if result.type in ('CONSTRUCT', 'DESCRIBE'):
+            if 'n-triples' in accept:
+                return ('application/n-triples', result.graph.serialize(format='nt', encoding='utf-8'))
+            return ('text/turtle', result.graph.serialize(format='turtle', encoding='utf-8'))
+        return ('application/sparql-results+json', result.serialize(format='json', encoding='utf-8'))
+
+    def respond(self, query, accept):
+        key = (query, accept)
+        with self._lock:
+            self.requests += 1
+            if key not in self.recorded:
+                ctype, body = self.evaluate(query, accept)
+                self.recorded[key] = (ctype, body, gzip.compress(body, compresslevel=1))
+            return self.recorded[key]
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle_query(self, params):
+                ctype, body, gzipped = stub.respond(params['query'][0], self.headers.get('Accept', ''))
+                encoded = 'gzip' in self.headers.get('Accept-Encoding', '')
+                if encoded:
+                    body = gzipped
+                self.send_response(200)
+                self.send_header('Content-Type', ctype)
+                if encoded:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.handle_query(parse_qs(urlsplit(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.handle_query(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        thread.start()
+        return "http://127.0.0.1:%d/sparql" % self._server.server_port
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,165 @@
+"""Admission control for SPARQL queries and expensive routes.
+
+Queries are admitted per query class, each class with its own limit on
+concurrent queries, so that a burst of expensive requests (e.g. searches
+or large agent pages) can't take up all endpoint connections. Queries over
+the limit wait in a bounded queue; when the queue is full or the wait
+times out, Overloaded is raised, which is answered with 503 and
+Retry-After unless a stale value can be served.
+
+Per-client token buckets can additionally limit the rate of search and
+RDF download requests.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from biblodui.endpoint import EndpointUnavailable
+
+# query class -> budget name; classes not listed use 'Resource'
+BUDGETS = {
+    'Search': 'Search',
+    'Suggestions': 'Search',
+    'Agent': 'Agent',
+    'Person': 'Agent',
+    'Organization': 'Agent',
+    'Work': 'Work',
+    'Collection': 'Work',
+    'SPARQL': 'SPARQL',
+}
+
+# budget name -> (max. concurrent queries, max. queued requests) per worker process;
+# the expensive classes together stay below ENDPOINT_POOL_SIZE, so that they
+# always leave a connection for the rest. A resource graph takes a slot for
+# each of its subqueries, so the limits of the graph classes are multiples
+# of those: three graphs of each class can be fetched at the same time.
+ADMISSION_LIMITS = {
+    'Search': (1, 20),
+    'Agent': (3 * 2, 10),
+    'Work': (3 * 5, 20),
+    'SPARQL': (1, 10),
+    'Resource': (10, 50),
+}
+ADMISSION_QUEUE_TIMEOUT = 5 # seconds a query may wait for admission
+OVERLOAD_RETRY_AFTER = 5 # seconds, sent with 503 responses when overloaded
+
+
+class Overloaded(EndpointUnavailable):
+    def __init__(self, budget, retry_after=OVERLOAD_RETRY_AFTER):
+        super(Overloaded, self).__init__("too many concurrent %s queries" % budget)
+        self.budget = budget
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """limits the number of concurrently held slots, with a bounded wait queue
+
+    A holder may take several slots at once, e.g. one for each subquery of
+    a resource graph, but never more than the limit."""
+
+    def __init__(self, name, limit, queue_size, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, slots=1):
+        """take slots, waiting for them in the queue if necessary; return
+        the number of slots taken, to be passed to release"""
+        slots = min(slots, self.limit)
+        with self._cond:
+            if self.active + slots <= self.limit and self.waiting == 0:
+                self.active += slots
+                self.admitted += 1
+                return slots
+            if self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise Overloaded(self.name)
+            self.waiting += 1
+            try:
+                admitted = self._cond.wait_for(lambda: self.active + slots <= self.limit,
+                                               self.queue_timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                self.rejected += 1
+                raise Overloaded(self.name)
+            self.active += slots
+            self.admitted += 1
+            return slots
+
+    def release(self, slots=1):
+        with self._cond:
+            self.active -= slots
+            # waiters may need different numbers of slots
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, slots=1):
+        slots = self.acquire(slots)
+        try:
+            yield
+        finally:
+            self.release(slots)
+
+
+limiters = {name: ConcurrencyLimiter(name, limit, queue_size)
+            for name, (limit, queue_size) in ADMISSION_LIMITS.items()}
+
+
+def limiter(query_class):
+    return limiters[BUDGETS.get(query_class, 'Resource')]
+
+
+class RateLimiter:
+    """per-client token buckets: rate requests per second, bursts of up to burst"""
+
+    def __init__(self, rate, burst, max_clients=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.rejected = 0
+        self._buckets = OrderedDict() # key: client, value: (tokens, time of last update)
+        self._lock = threading.Lock()
+
+    def allow(self, client):
+        """take a token for client; return 0 if there was one, or else the
+        number of seconds until there is"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                wait = 0
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.rejected += 1
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+def rate_limiter(setting):
+    """return a RateLimiter for a 'rate,burst' setting (e.g. '2,20'), or None if not set"""
+    if not setting:
+        return None
+    rate, burst = (float(value) for value in setting.split(','))
+    return RateLimiter(rate, burst)
+
+
+# route group -> RateLimiter or None, configured with e.g. BIBLODUI_SEARCH_RATE_LIMIT=2,20
+rate_limiters = {
+    'search': rate_limiter(os.environ.get('BIBLODUI_SEARCH_RATE_LIMIT')),
+    'download': rate_limiter(os.environ.get('BIBLODUI_DOWNLOAD_RATE_LIMIT')),
+    'sparql': rate_limiter(os.environ.get('BIBLODUI_SPARQL_RATE_LIMIT')),
+}
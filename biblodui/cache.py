@@ -0,0 +1,225 @@
+import threading
+import time
+from collections import OrderedDict
+
+# whether the current thread was given a stale value, see served_stale()
+_local = threading.local()
+
+
+def served_stale():
+    """return True if a stale value was served to this thread since reset_stale()"""
+    return getattr(_local, 'stale', False)
+
+
+def reset_stale():
+    _local.stale = False
+
+
+def mark_stale():
+    """flag the data given to this thread as stale, e.g. because it is incomplete"""
+    _local.stale = True
+
+
+class _Flight:
+    """a load in progress that other threads asking for the same key can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if self.stale:
+            _local.stale = True
+        return self.value
+
+
+class GraphCache:
+    """thread-safe LRU cache with TTL and single-flight loading
+
+    Concurrent requests for a key that is not cached share one call to the
+    loader instead of each running their own. Cached values are shared
+    between requests, so they must be treated as read-only.
+
+    Expired values are kept for another stale_ttl seconds. If reloading one
+    fails with one of stale_errors, the expired value is returned instead
+    and served_stale() becomes true for the thread."""
+
+    def __init__(self, maxsize=1000, ttl=3600, stale_ttl=0, stale_errors=()):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.stale_errors = stale_errors
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+        self._entries = OrderedDict() # key: cache key, value: (fetch time, value)
+        self._inflight = {} # key: cache key, value: _Flight
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        # must be called with the lock held
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        age = time.time() - entry[0]
+        if age > self.ttl:
+            if age > self.ttl + self.stale_ttl:
+                del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _stale_entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl + self.stale_ttl:
+                return None
+            self.stale += 1
+            return entry
+
+    def get(self, key, loader):
+        """return the cached value for key, calling loader() to produce it if needed"""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[1]
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                self.misses += 1
+                flight = _Flight()
+                self._inflight[key] = flight
+            else:
+                self.coalesced += 1
+        if not leader:
+            return flight.wait()
+
+        try:
+            flight.value = loader()
+        except Exception as e:
+            entry = self._stale_entry(key) if isinstance(e, self.stale_errors) else None
+            if entry is None:
+                flight.error = e
+                raise
+            flight.value = entry[1]
+            flight.stale = _local.stale = True
+        else:
+            self.put(key, flight.value)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+        return flight.value
+
+    def peek(self, key):
+        """return the cached value for key or None, without loading or counting a lookup"""
+        with self._lock:
+            entry = self._lookup(key)
+            return entry[1] if entry is not None else None
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """drop one key, or everything if no key is given"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """drop all keys for which predicate(key) is true"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'stale': self.stale,
+                'hit_ratio': (self.hits + self.coalesced) / lookups if lookups else 0.0}
+
+
+class RefreshingValue:
+    """a value that is reloaded in the background when older than interval
+
+    The current value keeps being served while a reload runs, and also when
+    a reload fails; failed reloads are retried after retry_interval. Only
+    the first load, when there is nothing to serve yet, is waited for."""
+
+    def __init__(self, loader, interval=3600, retry_interval=60):
+        self.loader = loader
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.value = None
+        self.loaded = None # time of the last successful load
+        self.error = None # exception raised by the last load, if it failed
+        self._attempted = None
+        self._idle = threading.Event() # set while no load is running
+        self._idle.set()
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """start a reload in the background if one is due (or forced) and none is running"""
+        with self._lock:
+            if not self._idle.is_set():
+                return
+            if not force and self._attempted is not None:
+                wait = self.interval if self.error is None else self.retry_interval
+                if time.time() - self._attempted < wait:
+                    return
+            self._attempted = time.time()
+            self._idle.clear()
+        threading.Thread(target=self._load, daemon=True).start()
+
+    def _load(self):
+        try:
+            value = self.loader()
+        except Exception as e:
+            self.error = e
+        else:
+            self.value = value
+            self.loaded = time.time()
+            self.error = None
+        finally:
+            self._idle.set()
+
+    def get(self):
+        """return the current value, waiting for it if it hasn't been loaded yet"""
+        if self.loaded is None:
+            self.refresh(force=True)
+            self._idle.wait()
+            if self.loaded is None:
+                raise self.error
+        else:
+            self.refresh()
+            if self.error is not None:
+                # the last reload failed
+                _local.stale = True
+        return self.value
@@ -0,0 +1,187 @@
+"""Persistent graph cache stored in an SQLite database.
+
+Several worker processes on the same host can share one database file, and
+its contents survive restarts. Graphs are stored as zlib-compressed
+N-Triples together with the time they were fetched from the endpoint. The
+total size of the stored graphs is kept up to date by triggers, so writes
+don't have to sum it up.
+
+The cache can be inspected and purged from the command line:
+
+    python -m biblodui.diskcache /var/cache/biblodui/graphs.db stats
+    python -m biblodui.diskcache /var/cache/biblodui/graphs.db list [URI-PREFIX]
+    python -m biblodui.diskcache /var/cache/biblodui/graphs.db purge [URI-PREFIX]
+"""
+
+import argparse
+import fcntl
+import sqlite3
+import threading
+import time
+import zlib
+
+
+def try_lock(path):
+    """return the open file at path holding an exclusive lock on it, or None
+    if another process holds it; the lock is held until the file is closed
+    or the process exits"""
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+class DiskGraphCache:
+    schema = """
+      CREATE TABLE IF NOT EXISTS graph (
+        cls TEXT NOT NULL,
+        uri TEXT NOT NULL,
+        fetched REAL NOT NULL,
+        accessed REAL NOT NULL,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL,
+        PRIMARY KEY (cls, uri)
+      );
+      CREATE INDEX IF NOT EXISTS graph_accessed ON graph (accessed);
+      BEGIN IMMEDIATE;
+      CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL
+      );
+      INSERT OR IGNORE INTO meta SELECT 'size', COALESCE(SUM(size), 0) FROM graph;
+      CREATE TRIGGER IF NOT EXISTS graph_insert AFTER INSERT ON graph BEGIN
+        UPDATE meta SET value = value + NEW.size WHERE key = 'size';
+      END;
+      CREATE TRIGGER IF NOT EXISTS graph_delete AFTER DELETE ON graph BEGIN
+        UPDATE meta SET value = value - OLD.size WHERE key = 'size';
+      END;
+      CREATE TRIGGER IF NOT EXISTS graph_update AFTER UPDATE OF size ON graph BEGIN
+        UPDATE meta SET value = value + NEW.size - OLD.size WHERE key = 'size';
+      END;
+      COMMIT;
+    """
+
+    # don't bother recording reads more often than this (seconds)
+    touch_interval = 60
+
+    def __init__(self, path, max_bytes=512 * 1024 * 1024, ttl=7 * 86400):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._local = threading.local()
+        self._connect().executescript(self.schema)
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # so that rows replaced by INSERT OR REPLACE fire the delete trigger
+            conn.execute('PRAGMA recursive_triggers=ON')
+            self._local.conn = conn
+        return conn
+
+    def get(self, cls, uri):
+        """return (fetch time, N-Triples bytes) or None if not cached or expired"""
+        conn = self._connect()
+        row = conn.execute('SELECT fetched, accessed, data FROM graph WHERE cls=? AND uri=?',
+                           (cls, str(uri))).fetchone()
+        if row is None:
+            return None
+        fetched, accessed, data = row
+        now = time.time()
+        if now - fetched > self.ttl:
+            return None
+        if now - accessed > self.touch_interval:
+            conn.execute('UPDATE graph SET accessed=? WHERE cls=? AND uri=?',
+                         (now, cls, str(uri)))
+        return (fetched, zlib.decompress(data))
+
+    def contains(self, cls, uri):
+        row = self._connect().execute('SELECT fetched FROM graph WHERE cls=? AND uri=?',
+                                      (cls, str(uri))).fetchone()
+        return row is not None and time.time() - row[0] <= self.ttl
+
+    def put(self, cls, uri, ntriples, fetched=None):
+        now = time.time()
+        if fetched is None:
+            fetched = now
+        data = zlib.compress(ntriples)
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO graph VALUES (?, ?, ?, ?, ?, ?)',
+                     (cls, str(uri), fetched, now, len(data), data))
+        self.evict()
+
+    def total_size(self):
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'size'").fetchone()[0]
+
+    def evict(self):
+        """drop least recently used entries until the cache fits in max_bytes"""
+        conn = self._connect()
+        excess = self.total_size() - self.max_bytes
+        if excess <= 0:
+            return 0
+        # read only as many of the oldest entries as need to go
+        victims = []
+        cursor = conn.execute('SELECT cls, uri, size FROM graph ORDER BY accessed')
+        for cls, uri, size in cursor:
+            victims.append((cls, uri))
+            excess -= size
+            if excess <= 0:
+                break
+        cursor.close()
+        conn.executemany('DELETE FROM graph WHERE cls=? AND uri=?', victims)
+        return len(victims)
+
+    def try_lock(self, name):
+        """return an open file holding the lock of this cache called name, or
+        None if another process holds it (see try_lock)
+
+        Lets one of the worker processes sharing the cache do work for all."""
+        return try_lock("%s.%s.lock" % (self.path, name))
+
+    def entries(self, prefix=''):
+        return self._connect().execute(
+            'SELECT cls, uri, fetched, accessed, size FROM graph WHERE substr(uri, 1, ?)=? ORDER BY uri',
+            (len(prefix), prefix)).fetchall()
+
+    def purge(self, prefix=''):
+        """remove entries whose URI starts with prefix (all entries by default)"""
+        cursor = self._connect().execute('DELETE FROM graph WHERE substr(uri, 1, ?)=?',
+                                         (len(prefix), prefix))
+        return cursor.rowcount
+
+    def stats(self):
+        count, size, oldest = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(fetched) FROM graph').fetchone()
+        return {'entries': count,
+                'bytes': size,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                'oldest_fetch': oldest}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or purge the persistent graph cache')
+    parser.add_argument('path', help='path to the cache database')
+    parser.add_argument('command', choices=('stats', 'list', 'purge'))
+    parser.add_argument('prefix', nargs='?', default='', help='only consider URIs starting with this')
+    args = parser.parse_args(argv)
+
+    cache = DiskGraphCache(args.path)
+    if args.command == 'stats':
+        for key, val in cache.stats().items():
+            print("%s: %s" % (key, val))
+    elif args.command == 'list':
+        for cls, uri, fetched, accessed, size in cache.entries(args.prefix):
+            print("%s\t%s\t%s\t%d" % (uri, cls, time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(fetched)), size))
+    elif args.command == 'purge':
+        print("purged %d entries" % cache.purge(args.prefix))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""Client for the SPARQL endpoint that reuses keep-alive HTTP connections.
+
+A single SPARQLClient is meant to be shared by all threads of a worker
+process. Idle connections are kept in a bounded pool and reused by
+subsequent queries, so most queries don't pay for a new TCP (and TLS)
+handshake.
+
+Each query has a deadline covering the wait for a free connection as well
+as sending the query and reading the response. An optional CircuitBreaker
+makes queries fail fast while the endpoint keeps failing; waiting in vain
+for a free connection doesn't count as a failure of the endpoint.
+"""
+
+import http.client
+import json
+import queue
+import socket
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from urllib.parse import urlsplit, urlencode
+
+TURTLE = 'text/turtle'
+NTRIPLES = 'application/n-triples'
+SPARQL_JSON = 'application/sparql-results+json'
+
+# queries longer than this are sent using POST instead of GET
+MAX_GET_QUERY_LENGTH = 2000
+
+# bytes read at a time, checking the deadline in between
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class EndpointError(Exception):
+    def __init__(self, status, reason, body=b''):
+        super(EndpointError, self).__init__("SPARQL endpoint returned %d %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+class EndpointUnavailable(Exception):
+    """the endpoint is not answering: its circuit is open or a query timed out"""
+
+
+class QueryTimeout(EndpointUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """fails queries fast while the endpoint keeps failing
+
+    After failure_threshold consecutive failures (timeouts, connection
+    errors or 5xx responses) the circuit opens and queries are refused for
+    reset_timeout seconds. Then a single query is let through as a probe: if
+    it succeeds the circuit closes, otherwise it stays open for another
+    reset_timeout seconds."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0 # consecutive failures
+        self.opened = None # time.monotonic() when the circuit last opened
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """return True if a query may be sent now"""
+        with self._lock:
+            if self.opened is None:
+                return True
+            if self._probing or time.monotonic() - self.opened < self.reset_timeout:
+                return False
+            self._probing = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                self.opened = time.monotonic()
+            self._probing = False
+
+    def state(self):
+        with self._lock:
+            if self.opened is None:
+                return 'closed'
+            if self._probing or time.monotonic() - self.opened >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def retry_after(self):
+        """return the number of seconds until the next probe (0 if the circuit is closed)"""
+        with self._lock:
+            if self.opened is None:
+                return 0
+            return max(self.reset_timeout - (time.monotonic() - self.opened), 0)
+
+
+def remaining(deadline):
+    """return the seconds left until deadline (a time.monotonic() value)"""
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise QueryTimeout("SPARQL query exceeded its deadline")
+    return left
+
+
+class ConnectionPool:
+    """bounded, thread-safe pool of keep-alive connections to one host"""
+
+    def __init__(self, scheme, host, port, size=10, connect_timeout=5, read_timeout=60):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self, timeout=None):
+        timeout = min(self.connect_timeout, timeout or self.connect_timeout)
+        if self.scheme == 'https':
+            conn = http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn
+
+    def reserve(self, timeout=None):
+        """take a connection slot - blocks while all connections are in use,
+        for at most timeout seconds"""
+        if not self._slots.acquire(timeout=timeout):
+            raise QueryTimeout("no free connection to the SPARQL endpoint")
+
+    def acquire(self, timeout=None):
+        """return (connection, reused) for a reserved slot, connecting if no
+        idle connection is left; the slot stays reserved if this fails"""
+        try:
+            return (self._idle.get_nowait(), True)
+        except queue.Empty:
+            pass
+        return (self.connect(timeout), False)
+
+    def release(self, conn=None, reusable=True):
+        """release a slot, with the connection acquired for it if any"""
+        if conn is not None:
+            if reusable:
+                self._idle.put(conn)
+            else:
+                conn.close()
+        self._slots.release()
+
+    def close(self):
+        """close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class SPARQLClient:
+    def __init__(self, url, pool_size=10, connect_timeout=5, read_timeout=60,
+                 timeout=None, breaker=None):
+        self.url = url
+        parts = urlsplit(url)
+        self.path = parts.path or '/'
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.pool = ConnectionPool(parts.scheme, parts.hostname, port,
+                                   pool_size, connect_timeout, read_timeout)
+        self.timeout = timeout or read_timeout # default deadline of a query, in seconds
+        self.breaker = breaker
+
+    @contextmanager
+    def _guarded(self, deadline):
+        """reserve a connection slot, refuse to run while the circuit is open,
+        and report the outcome to the breaker
+
+        The slot is reserved before asking the breaker, so that running out
+        of connections isn't reported as a failure of the endpoint. Within
+        the block the slot must be released with the connection."""
+        self.pool.reserve(remaining(deadline))
+        breaker = self.breaker
+        if breaker is not None and not breaker.allow():
+            self.pool.release()
+            raise EndpointUnavailable("SPARQL endpoint circuit is open")
+        try:
+            yield
+        except socket.timeout as e:
+            if breaker is not None:
+                breaker.failure()
+            raise QueryTimeout("SPARQL query timed out") from e
+        except EndpointError as e:
+            if breaker is not None:
+                # the endpoint is answering, a 4xx response is a problem with the query
+                if e.status >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+            raise
+        except BaseException:
+            if breaker is not None:
+                breaker.failure()
+            raise
+        else:
+            if breaker is not None:
+                breaker.success()
+
+    def _settimeout(self, conn, deadline):
+        if conn.sock is not None:
+            conn.sock.settimeout(min(remaining(deadline), self.pool.read_timeout))
+
+    def _send(self, conn, query, accept):
+        headers = {'Accept': accept, 'Accept-Encoding': 'gzip'}
+        params = urlencode({'query': query})
+        if len(query) > MAX_GET_QUERY_LENGTH:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            conn.request('POST', self.path, body=params, headers=headers)
+        else:
+            conn.request('GET', "%s?%s" % (self.path, params), headers=headers)
+        return conn.getresponse()
+
+    def _request(self, query, accept, deadline):
+        """send a query using the reserved slot and return (connection,
+        response) for reading the body"""
+        try:
+            conn, reused = self.pool.acquire(remaining(deadline))
+        except BaseException:
+            self.pool.release()
+            raise
+        try:
+            try:
+                self._settimeout(conn, deadline)
+                response = self._send(conn, query, accept)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                if not reused:
+                    raise
+                # the server closed an idle keep-alive connection, try once more
+                conn.close()
+                conn = self.pool.connect(remaining(deadline))
+                self._settimeout(conn, deadline)
+                response = self._send(conn, query, accept)
+        except BaseException:
+            self.pool.release(conn, reusable=False)
+            raise
+        return (conn, response)
+
+    def query(self, query, accept, timeout=None):
+        """run a query and return the (decompressed) response body as bytes
+
+        Raises QueryTimeout if the query takes longer than timeout (by
+        default self.timeout) seconds in total."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        with self._guarded(deadline):
+            conn, response = self._request(query, accept, deadline)
+            try:
+                chunks = []
+                while True:
+                    self._settimeout(conn, deadline)
+                    chunk = response.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                body = b''.join(chunks)
+            except BaseException:
+                self.pool.release(conn, reusable=False)
+                raise
+            self.pool.release(conn, reusable=not response.will_close)
+
+            if response.getheader('Content-Encoding', '').lower() == 'gzip':
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            if response.status != 200:
+                raise EndpointError(response.status, response.reason, body)
+        return body
+
+    def close(self):
+        self.pool.close()
+
+    def select(self, query, timeout=None):
+        """run a SELECT or ASK query and return the decoded JSON results"""
+        return json.loads(self.query(query, SPARQL_JSON, timeout).decode('utf-8'))
@@ -0,0 +1,133 @@
+"""Bulk export of resource graphs.
+
+The resources are grouped by class (as recognized by model.get_resource)
+and fetched in chunks, using the download and reverse queries of the class
+rewritten to take the URIs of a whole chunk in a VALUES clause. The
+combined graph of a chunk is split again per resource: the statements
+about the resource, about the blank nodes and resources the download
+query describes along with it (see Resource.download_paths), and the
+works linking to it are the same statements as in the N-Triples download
+of the single resource. Chunks that can't be fetched are left out with a
+comment line for each of their resources.
+"""
+
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rdflib import URIRef, BNode
+from rdflib.plugins.serializers.nt import _nt_row
+
+from biblodui import model, metrics
+from biblodui.serializers import _chunks
+from biblodui.triplestore import GraphBuilder
+
+EXPORT_CHUNK_SIZE = 50 # resources per query
+EXPORT_CONCURRENCY = 4 # chunks fetched at the same time
+EXPORT_MAX_RESOURCES = 10000 # per request
+
+# fetches chunks for all export requests of the process
+export_pool = ThreadPoolExecutor(EXPORT_CONCURRENCY, thread_name_prefix='export')
+
+# URIs that can be safely written into a query
+SAFE_URI = re.compile(r'^https?://[^\s<>"{}|\\^`]+$')
+
+
+def resolve_id(ident):
+    """return the URI for a resource ID (e.g. W00009584101), URL path or URI"""
+    ident = ident.strip()
+    if ident.startswith('/'):
+        return model.url_to_uri(ident)
+    if '://' not in ident:
+        return 'http://urn.fi/URN:NBN:fi:bib:me:' + ident
+    return ident
+
+
+def chunks(uris):
+    """yield (class, URIs) chunks of at most EXPORT_CHUNK_SIZE resources of one class"""
+    by_class = OrderedDict()
+    for uri in uris:
+        by_class.setdefault(type(model.get_resource(uri)), []).append(uri)
+    for cls, class_uris in by_class.items():
+        for start in range(0, len(class_uris), EXPORT_CHUNK_SIZE):
+            yield (cls, class_uris[start:start + EXPORT_CHUNK_SIZE])
+
+
+def fetch_chunk(cls, uris):
+    builder = GraphBuilder()
+    for query in cls.batch_queries(uris):
+        data = model.timed_query('Export', model.sparql.query, query, model.GRAPH_MEDIA_TYPES[model.GRAPH_FORMAT])
+        metrics.SPARQL_BYTES.observe(len(data), 'Export')
+        with metrics.PARSE_SECONDS.time('Export'):
+            model.parse_graph(data, builder)
+    return builder.build()
+
+
+def describe(graph, uri, paths=(), reverse_properties=()):
+    """return the statements of graph about uri and the blank nodes and
+    resources reachable from it via paths, and the named resources linking
+    to uri via reverse_properties"""
+    triples = []
+    seen = {uri}
+    queue = [uri]
+    while queue:
+        node = queue.pop()
+        for pred, obj in graph.predicate_objects(node):
+            triples.append((node, pred, obj))
+            if obj not in seen and (isinstance(obj, BNode) or pred in paths):
+                seen.add(obj)
+                queue.append(obj)
+    for subj, pred, obj in graph.triples((None, None, uri)):
+        if pred in reverse_properties:
+            names = [(subj, model.SCHEMA.name, name) for name in graph.objects(subj, model.SCHEMA.name)]
+            if names:
+                triples.append((subj, pred, uri))
+                triples.extend(names)
+    return list(OrderedDict.fromkeys(triples))
+
+
+def iter_export(uris, fmt='nt'):
+    """yield the graphs of the resources as 'nt' or 'nquads' in chunks of bytes
+
+    In N-Quads, each resource is in a named graph with the URI of the
+    resource; in N-Triples the statements are grouped by resource."""
+    return _chunks(_export_lines(uris, fmt))
+
+
+def _export_lines(uris, fmt):
+    valid = []
+    for uri in OrderedDict.fromkeys(uris):
+        if SAFE_URI.match(uri):
+            valid.append(uri)
+        else:
+            yield "# invalid URI: %s\n" % uri
+    pending = []
+    for cls, chunk in chunks(valid):
+        pending.append((cls, chunk, export_pool.submit(fetch_chunk, cls, chunk)))
+        # keep a bounded number of chunks in flight, and the output in order
+        if len(pending) >= EXPORT_CONCURRENCY:
+            yield from _chunk_lines(*pending.pop(0), fmt)
+    for cls, chunk, future in pending:
+        yield from _chunk_lines(cls, chunk, future, fmt)
+
+
+def _chunk_lines(cls, chunk, future, fmt):
+    try:
+        graph = future.result()
+    except Exception:
+        # the response has already started, carry on with the other chunks
+        for uri in chunk:
+            yield "# failed: <%s>\n" % uri
+        return
+    reverse_properties = cls.reverse_properties()
+    for uri in chunk:
+        triples = describe(graph, URIRef(uri), cls.download_paths, reverse_properties)
+        if not triples:
+            yield "# not found: <%s>\n" % uri
+        elif fmt == 'nquads':
+            context = " <%s> .\n" % uri
+            for triple in triples:
+                yield _nt_row(triple)[:-3] + context
+        else:
+            for triple in triples:
+                yield _nt_row(triple)
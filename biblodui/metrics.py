@@ -0,0 +1,154 @@
+"""Metrics in the Prometheus text format, served on /metrics.
+
+Counters and histograms are kept in memory by each worker process and are
+cheap to update: one lock and a few additions per observation. Values that
+other components already count, such as cache statistics, are read only
+when the metrics are scraped. With several worker processes, each scrape
+reports the process that happened to handle it.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds of histogram buckets
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+# all metrics and collectors, in output order
+_metrics = []
+_collectors = []
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {} # key: label values, value: count
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append("%s%s %s" % (self.name, _format_labels(self.labelnames, labels), _format_value(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {} # key: label values, value: [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 3)
+            entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def time(self, *labels):
+        """return a context manager observing the time spent in its block"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        with self._lock:
+            values = sorted((labels, list(entry)) for labels, entry in self._values.items())
+        for labels, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), entry):
+                cumulative += count
+                lines.append("%s_bucket%s %d" % (self.name, _format_labels(self.labelnames, labels, [('le', _format_value(float(bound)))]), cumulative))
+            lines.append("%s_sum%s %s" % (self.name, _format_labels(self.labelnames, labels), _format_value(entry[-2])))
+            lines.append("%s_count%s %d" % (self.name, _format_labels(self.labelnames, labels), entry[-1]))
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+def collector(func):
+    """register a function returning [(name, type, help, [(labels dict, value)])] to call on scrape"""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """return all metrics in the Prometheus text format"""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for func in _collectors:
+        for name, kind, help, samples in func():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, _format_labels(list(labels), list(labels.values())), _format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+REQUESTS = Counter('biblodui_requests_total', 'HTTP requests handled',
+                   ('route', 'format', 'status'))
+REQUEST_SECONDS = Histogram('biblodui_request_duration_seconds',
+                            'Time until the response headers were ready',
+                            ('route', 'format'))
+RESPONSE_BYTES = Histogram('biblodui_response_bytes', 'Size of non-streamed response bodies',
+                           ('route', 'format'), SIZE_BUCKETS)
+SPARQL_SECONDS = Histogram('biblodui_sparql_query_duration_seconds', 'SPARQL query latency',
+                           ('query_class',))
+SPARQL_ERRORS = Counter('biblodui_sparql_errors_total', 'Failed or timed out SPARQL queries',
+                        ('query_class',))
+SPARQL_BYTES = Histogram('biblodui_sparql_response_bytes', 'Size of SPARQL responses',
+                         ('query_class',), SIZE_BUCKETS)
+GRAPH_TRIPLES = Histogram('biblodui_graph_triples', 'Number of triples in fetched resource graphs',
+                          ('query_class',), COUNT_BUCKETS)
+PARSE_SECONDS = Histogram('biblodui_parse_duration_seconds', 'Time spent parsing SPARQL responses',
+                          ('query_class',))
+RENDER_SECONDS = Histogram('biblodui_render_duration_seconds',
+                           'Time spent rendering pages and serializing RDF (not streamed)',
+                           ('format',))
+STALE_RESPONSES = Counter('biblodui_stale_responses_total',
+                          'Responses built from stale data while the endpoint was failing')
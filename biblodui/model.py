@@ -1,15 +1,188 @@
 from collections import OrderedDict
-from SPARQLWrapper import SPARQLWrapper, JSON, TURTLE
-from rdflib import Graph, URIRef, Namespace, RDF, RDFS, BNode
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from weakref import WeakKeyDictionary
+from rdflib import Graph, URIRef, Literal, Namespace, RDF, RDFS, BNode
 from rdflib.namespace import SKOS, DC
 
+import hashlib
 import os
 import os.path
+import re
+import time
+
+from biblodui import admission, metrics
+from biblodui.cache import GraphCache, RefreshingValue, mark_stale, served_stale, reset_stale
+from biblodui.diskcache import DiskGraphCache
+from biblodui.endpoint import SPARQLClient, CircuitBreaker, EndpointError, EndpointUnavailable, QueryTimeout, remaining, TURTLE, NTRIPLES
+from biblodui.ntparser import parse_ntriples
+from biblodui.serializers import iter_ntriples, iter_turtle, graph_digest
+from biblodui.triplestore import GraphBuilder
 
 SCHEMA = Namespace('http://schema.org/')
 RDAU = Namespace('http://rdaregistry.info/Elements/u/')
 
 ENDPOINT = "http://data.nationallibrary.fi/bib/sparql"
+ENDPOINT_POOL_SIZE = 24 # max. number of concurrent connections per worker process
+ENDPOINT_CONNECT_TIMEOUT = 5 # seconds
+ENDPOINT_READ_TIMEOUT = 60 # seconds
+ENDPOINT_QUERY_TIMEOUT = 20 # seconds, total time limit of a query
+ENDPOINT_FAILURE_THRESHOLD = 5 # consecutive failures that open the circuit
+ENDPOINT_RESET_TIMEOUT = 30 # seconds before a query is let through to probe the endpoint
+
+# shared by all threads of the process
+breaker = CircuitBreaker(ENDPOINT_FAILURE_THRESHOLD, ENDPOINT_RESET_TIMEOUT)
+sparql = SPARQLClient(ENDPOINT, ENDPOINT_POOL_SIZE, ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_READ_TIMEOUT,
+                      ENDPOINT_QUERY_TIMEOUT, breaker)
+
+# when queries fail, expired values are served from the caches for this long
+STALE_TTL = 86400 # seconds
+STALE_ERRORS = (EndpointError, EndpointUnavailable, OSError)
+
+FETCH_WORKERS = ENDPOINT_POOL_SIZE # threads running subqueries of resource graphs
+SUBQUERY_TIMEOUT = 10 # seconds, for the optional subqueries of a resource graph
+
+# runs the subqueries of resource graphs concurrently; they are admitted
+# in the requesting thread, so its threads never wait for admission
+fetch_pool = ThreadPoolExecutor(FETCH_WORKERS, thread_name_prefix='fetch')
+
+def observed_query(query_class, func, *args):
+    """call func (e.g. sparql.select) with args, recording the latency"""
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    except Exception:
+        metrics.SPARQL_ERRORS.inc(query_class)
+        raise
+    finally:
+        metrics.SPARQL_SECONDS.observe(time.perf_counter() - start, query_class)
+
+def query_until(query_class, deadline, func, *args):
+    """call func (sparql.query or sparql.select) with args and a timeout
+    ending at deadline (a time.monotonic() value), recording the latency"""
+    return observed_query(query_class, func, *(args + (remaining(deadline),)))
+
+def timed_query(query_class, func, *args):
+    """call func (e.g. sparql.select) with args once admitted under the budget
+    of query_class (see biblodui.admission), recording the latency"""
+    with admission.limiter(query_class).slot():
+        return observed_query(query_class, func, *args)
+
+GRAPH_CACHE_SIZE = 1000 # number of resource graphs kept in memory
+GRAPH_CACHE_TTL = 3600 # seconds
+
+# resource graphs keyed by (class name, URI) or (class name, URI, 'download'),
+# shared by all requests
+graph_cache = GraphCache(GRAPH_CACHE_SIZE, GRAPH_CACHE_TTL, STALE_TTL, STALE_ERRORS)
+
+LOOKUP_CACHE_SIZE = 10000 # number of instance works and existence checks kept
+EXISTS_CACHE_TTL = 300 # seconds
+
+# results of instance work lookups, keyed by URI
+instance_work_cache = GraphCache(LOOKUP_CACHE_SIZE, GRAPH_CACHE_TTL, STALE_TTL, STALE_ERRORS)
+
+# results of existence checks (ASK queries) of resources whose graph isn't
+# cached, keyed by URI; kept briefly, mostly to answer repeated 404s
+exists_cache = GraphCache(LOOKUP_CACHE_SIZE, EXISTS_CACHE_TTL)
+
+# optional SQLite database shared by all worker processes on the host
+DISK_CACHE_PATH = os.environ.get('BIBLODUI_DISK_CACHE')
+DISK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+DISK_CACHE_TTL = 7 * 86400 # seconds
+
+if DISK_CACHE_PATH:
+    disk_cache = DiskGraphCache(DISK_CACHE_PATH, DISK_CACHE_MAX_BYTES, DISK_CACHE_TTL)
+else:
+    disk_cache = None
+
+# format in which graphs are fetched from the endpoint: 'nt' is read with
+# the fast parser in biblodui.ntparser, 'turtle' with rdflib's parser
+GRAPH_FORMAT = 'nt'
+GRAPH_MEDIA_TYPES = {'nt': NTRIPLES, 'turtle': TURTLE}
+
+def parse_graph(data, graph, fmt=None):
+    """parse an endpoint response (bytes) in GRAPH_FORMAT or fmt into graph (or a GraphBuilder)"""
+    fmt = fmt or GRAPH_FORMAT
+    if fmt == 'nt':
+        return parse_ntriples(data, graph)
+    for triple in Graph().parse(data=data.decode('utf-8'), format=fmt):
+        graph.add(triple)
+    return graph
+
+# fetch time and content digest of loaded graphs
+graph_info = WeakKeyDictionary() # key: Graph, value: dict
+
+# properties used for the names of resources, in order of preference
+LABEL_PROPERTIES = (SCHEMA.name, SKOS.prefLabel, DC.title, RDFS.label)
+
+
+class LabelIndex:
+    """the preferred label of every labelled subject
+
+    Labels in English are preferred, then labels of properties earlier in
+    LABEL_PROPERTIES; among equals, the first one seen wins."""
+
+    def __init__(self, labels):
+        """labels is an iterable of (subject, property rank, label)"""
+        best = {} # key: subject, value: (rank, label)
+        for subject, prop_rank, label in labels:
+            rank = (getattr(label, 'language', None) != 'en', prop_rank)
+            if subject not in best or rank < best[subject][0]:
+                best[subject] = (rank, label)
+        self.labels = {subject: label for subject, (rank, label) in best.items()}
+
+    @classmethod
+    def for_graph(cls, graph):
+        return cls((s, rank, o) for rank, prop in enumerate(LABEL_PROPERTIES)
+                   for s, p, o in graph.triples((None, prop, None)))
+
+    def name(self, subject, default=None):
+        return self.labels.get(subject, default)
+
+def label_index(graph):
+    """return the LabelIndex of a graph, built once per loaded graph"""
+    info = graph_info.setdefault(graph, {})
+    if 'labels' not in info:
+        info['labels'] = LabelIndex.for_graph(graph)
+    return info['labels']
+
+# prefixes used in streamed Turtle
+TURTLE_PREFIXES = (
+    ('schema', SCHEMA),
+    ('rdau', RDAU),
+    ('skos', SKOS),
+    ('dc', DC),
+    ('rdf', RDF),
+    ('rdfs', RDFS),
+)
+
+# lists of works linked to a resource, by the property linking them
+WORK_LISTS = {
+    'authored': SCHEMA.author,
+    'contributed': SCHEMA.contributor,
+    'about': SCHEMA.about,
+}
+WORK_LIST_PAGE_SIZE = 100
+
+# pages of work lists keyed by (URI, property, page), shared by all requests
+list_cache = GraphCache(GRAPH_CACHE_SIZE, GRAPH_CACHE_TTL, STALE_TTL, STALE_ERRORS)
+
+INDEX_REFRESH_INTERVAL = 3600 # seconds between reloads of the index page lists
+INDEX_RETRY_INTERVAL = 60 # seconds, after a failed reload
+
+SEARCH_WINDOW = 100 # number of top ranked text index hits considered for a search
+SEARCH_CACHE_SIZE = 1000
+SEARCH_CACHE_TTL = 300 # seconds
+
+# ranked search results keyed by normalized query, for paging
+search_cache = GraphCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, STALE_TTL, STALE_ERRORS)
+
+SUGGEST_MIN_CHARS = 3
+SUGGEST_SEARCH_LIMIT = 100 # max. number of text index hits fetched per query
+SUGGEST_CACHE_SIZE = 10000
+SUGGEST_CACHE_TTL = 600 # seconds
+
+# autocomplete suggestions keyed by normalized query string
+suggest_cache = GraphCache(SUGGEST_CACHE_SIZE, SUGGEST_CACHE_TTL)
 
 def get_resource(uri, graph=None):
     """return a Resource object of the appropriate class for the given URI"""
@@ -48,6 +221,32 @@ def uri_to_url(uri):
     url = url.replace('http://www.yso.fi/onto/yso/','/yso/')
     return url
 
+URL_PREFIXES = (
+    ('/bib/me/', 'http://urn.fi/URN:NBN:fi:bib:me:'),
+    ('/au/pn/', 'http://urn.fi/URN:NBN:fi:au:pn:'),
+    ('/au/cn/', 'http://urn.fi/URN:NBN:fi:au:cn:'),
+    ('/yso/', 'http://www.yso.fi/onto/yso/'),
+)
+
+def url_to_uri(url):
+    """inverse of uri_to_url; URIs are returned as is"""
+    for path, base in URL_PREFIXES:
+        if url.startswith(path):
+            return base + url[len(path):]
+    return url
+
+def invalidate(uri_prefix=''):
+    """drop cached graphs and work lists of resources whose URI starts with uri_prefix"""
+    graph_cache.invalidate_where(lambda key: str(key[1]).startswith(uri_prefix))
+    list_cache.invalidate_where(lambda key: str(key[1]).startswith(uri_prefix))
+    instance_work_cache.invalidate_where(lambda key: key.startswith(uri_prefix))
+    exists_cache.invalidate_where(lambda key: key.startswith(uri_prefix))
+    if not uri_prefix:
+        search_cache.invalidate()
+        suggest_cache.invalidate()
+        collections_data.refresh(force=True)
+        conceptschemes_data.refresh(force=True)
+
 
 class Resource:
     prefixes = """
@@ -55,75 +254,244 @@ class Resource:
       PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
     """
 
-    query = """
+    # names of the work lists (see WORK_LISTS) shown for this class
+    work_lists = ('about',)
+
+    # The graph served in the RDF formats: the statements about the resource
+    # and the names of the blank nodes it links to. The labels of linked
+    # resources are only needed for the HTML pages (see subqueries).
+    download_query = """
       %(prefixes)s
-      
+
       CONSTRUCT {
         <%(uri)s> ?p ?o .
         ?o schema:name ?oname ;
            skos:prefLabel ?olabel .
+      }
+      WHERE {
+        <%(uri)s> ?p ?o .
+        OPTIONAL {
+          { ?o schema:name ?oname }
+          UNION
+          { ?o skos:prefLabel ?olabel }
+          FILTER(isBlank(?o))
+        }
+      }
+    """
+
+    exists_query = """
+      ASK { <%(uri)s> ?p ?o }
+    """
+
+    # properties via which download_query also includes the statements of
+    # linked resources, besides those of blank nodes
+    download_paths = ()
+
+    # The works linking to the resource (see work_lists), with their names.
+    # The RDF formats include them; the HTML pages list them page by page
+    # instead (see WorkList).
+    reverse_query = """
+      %(prefixes)s
+
+      CONSTRUCT {
         ?wab schema:about <%(uri)s> ;
              schema:name ?wabname .
       }
       WHERE {
-        {
-          <%(uri)s> ?p ?o .
-          OPTIONAL {
+        ?wab schema:about <%(uri)s> ;
+             schema:name ?wabname .
+      }
+    """
+
+    # The resource graph is fetched using these CONSTRUCT queries, which are
+    # run concurrently and merged: (name, query, required). Optional ones
+    # that fail or take longer than SUBQUERY_TIMEOUT are left out. Blank
+    # nodes can't be matched between query results, so each query must
+    # include the statements linking to the blank nodes it describes.
+    subqueries = (
+        ('core', download_query, True),
+        ('labels', """
+          %(prefixes)s
+
+          CONSTRUCT {
+            ?o schema:name ?oname ;
+               skos:prefLabel ?olabel .
+          }
+          WHERE {
+            <%(uri)s> ?p ?o .
+            FILTER(isIRI(?o))
             { ?o schema:name ?oname }
             UNION
             { ?o skos:prefLabel ?olabel }
           }
-        }
-        UNION
-        { # works about
-          ?wab schema:about <%(uri)s> .
-          ?wab schema:name ?wabname .
-        }
-      }
-    """
+        """, False),
+    )
 
-    def __init__(self, uri, graph = None):
+    def __init__(self, uri, graph = None, download = False):
         if isinstance(uri, URIRef) or isinstance(uri, BNode):
             self.uri = uri
         else:
             self.uri = URIRef(uri)
+        self._work_lists = {} # key: (list name, page), value: WorkList
+        self._graph = graph
+        # if True, the graph is fetched with download_query
+        self.download = download
 
-        if graph is not None:
-            self.graph = graph
-        else:
-            self.graph = self.query_for_graph()
+    def for_download(self):
+        """return this resource with the graph served in the RDF formats"""
+        return self.__class__(self.uri, download=True)
+
+    @property
+    def graph(self):
+        # the graph is loaded on first use
+        if self._graph is None:
+            self._graph = self.query_for_graph()
+        return self._graph
+
+    def cache_key(self):
+        if self.download:
+            return (self.typename(), str(self.uri), 'download')
+        return (self.typename(), str(self.uri))
+
+    def disk_cache_class(self):
+        return self.typename() + ('/download' if self.download else '')
+
+    def is_cached(self):
+        """return True if the graph can be loaded without querying the endpoint"""
+        if self._graph is not None or self.cache_key() in graph_cache:
+            return True
+        return disk_cache is not None and disk_cache.contains(self.disk_cache_class(), self.uri)
     
     def query_for_graph(self):
-        sparql = SPARQLWrapper(ENDPOINT, returnFormat=TURTLE)
-        sparql.setOnlyConneg(True)
-        sparql.setQuery(self.query % {'uri': self.uri, 'prefixes': self.prefixes})
-        graph = Graph()
-        graph.parse(sparql.query().response, format='turtle')
+        # the cached graph is shared between requests and must not be modified
+        graph = graph_cache.get(self.cache_key(), self.fetch_graph)
+        if graph_info.get(graph, {}).get('missing'):
+            # incomplete, try again on the next request, and let responses
+            # using it be cached only briefly, like ones using stale data
+            graph_cache.invalidate(self.cache_key())
+            mark_stale()
+        return graph
+
+    def fetch_graph(self):
+        if disk_cache is not None:
+            cached = disk_cache.get(self.disk_cache_class(), self.uri)
+            if cached is not None:
+                with metrics.PARSE_SECONDS.time('DiskCache'):
+                    graph = parse_graph(cached[1], GraphBuilder(), 'nt').build()
+                graph_info[graph] = {'fetched': cached[0]}
+                return graph
+        graph = self.query_endpoint()
+        graph_info[graph]['fetched'] = time.time()
+        if disk_cache is not None and len(graph) > 0 and not graph_info[graph]['missing']:
+            disk_cache.put(self.disk_cache_class(), self.uri, b''.join(iter_ntriples(graph)))
+        return graph
+
+    @classmethod
+    def batch_queries(cls, uris):
+        """return download_query and reverse_query rewritten to fetch the
+        download graphs of several resources at once"""
+        values = "VALUES ?resource { %s }" % " ".join("<%s>" % uri for uri in uris)
+        queries = []
+        for query in (cls.download_query, cls.reverse_query):
+            query = query % {'uri': '__RESOURCE__', 'prefixes': cls.prefixes}
+            query = query.replace('<__RESOURCE__>', '?resource').replace('WHERE {', 'WHERE {\n' + values, 1)
+            queries.append(query)
+        return queries
+
+    def construct_query(self, query):
+        return query % {'uri': self.uri, 'prefixes': self.prefixes}
+
+    @classmethod
+    def reverse_properties(cls):
+        """return the properties of the links included by reverse_query"""
+        return [WORK_LISTS[name] for name in cls.work_lists]
+
+    def fetch_queries(self):
+        """return the (name, query, required) queries the graph is fetched with"""
+        if self.download:
+            return (('download', self.download_query, True), ('reverse', self.reverse_query, True))
+        return self.subqueries
+
+    def query_endpoint(self):
+        """run the subqueries concurrently and merge their results into one graph
+
+        The fetch is admitted once, taking a slot of its budget for each
+        subquery. The deadlines of the subqueries start before admission,
+        so they also cover the waits for admission and for a fetch thread.
+        The names of optional subqueries that didn't complete are recorded
+        under 'missing' in graph_info."""
+        query_class = self.typename()
+        queries = self.fetch_queries()
+        start = time.monotonic()
+        with admission.limiter(query_class).slot(len(queries)):
+            return self.run_subqueries(query_class, queries, start)
+
+    def run_subqueries(self, query_class, queries, start):
+        deadline = start + sparql.timeout
+        optional_deadline = min(start + SUBQUERY_TIMEOUT, deadline)
+        futures = [(name, required,
+                    fetch_pool.submit(query_until, query_class, deadline if required else optional_deadline,
+                                      sparql.query, self.construct_query(query),
+                                      GRAPH_MEDIA_TYPES[GRAPH_FORMAT]))
+                   for name, query, required in queries]
+        builder = GraphBuilder()
+        missing = []
+        # parse results in order while the rest are still running
+        for name, required, future in futures:
+            if required:
+                try:
+                    data = future.result(timeout=max(deadline - time.monotonic(), 0))
+                except FutureTimeout:
+                    future.cancel()
+                    raise QueryTimeout("%s query of %s exceeded its deadline" % (name, self.uri))
+            else:
+                try:
+                    data = future.result(timeout=max(optional_deadline - time.monotonic(), 0))
+                except Exception:
+                    future.cancel()
+                    missing.append(name)
+                    continue
+            metrics.SPARQL_BYTES.observe(len(data), query_class)
+            with metrics.PARSE_SECONDS.time(query_class):
+                parse_graph(data, builder)
+        graph = builder.build()
+        metrics.GRAPH_TRIPLES.observe(len(graph), query_class)
+        graph_info[graph] = {'missing': missing}
         return graph
     
     def exists(self):
+        """return True if there are statements about the resource
+
+        This loads the graph, which every route answering with the resource
+        needs anyway. If it isn't cached, an ASK query checks first, so that
+        requests for missing resources don't run all the subqueries of a
+        graph and take up their admission budget."""
+        if not self.is_cached() and not exists_cache.get(str(self.uri), self.query_exists):
+            return False
         return len(self.graph) > 0
+
+    def query_exists(self):
+        return timed_query('Exists', sparql.select, self.exists_query % {'uri': self.uri})['boolean']
+
+    def fetched(self):
+        """return the time (as a timestamp) the graph was fetched from the endpoint, or None"""
+        return graph_info.get(self.graph, {}).get('fetched')
+
+    def digest(self):
+        """return a hash of the graph contents, computed once per loaded graph"""
+        info = graph_info.setdefault(self.graph, {})
+        if 'digest' not in info:
+            info['digest'] = graph_digest(self.graph)
+        return info['digest']
     
     def typename(self):
         return self.__class__.__name__
 
     def name(self):
-        props = (SCHEMA.name, SKOS.prefLabel, DC.title, RDFS.label)
-        labels = self.graph.preferredLabel(self.uri, lang='en', labelProperties=props)
-        if len(labels) > 0:
-            return labels[0][1]
-
-        labels = self.graph.preferredLabel(self.uri, labelProperties=props)
-        if len(labels) > 0:
-            return labels[0][1]
-        
-        return "<%s>" % self.uri
+        return label_index(self.graph).name(self.uri, "<%s>" % self.uri)
     
     def __str__(self):
         return self.name()
-      
-    def sort_key(self):
-        return self.name().lower()
     
     def url(self):
         if isinstance(self.uri, BNode):
@@ -136,74 +504,74 @@ class Resource:
             return 'index'
         return ln
     
-    def property_name(self, prop):
-        return prop.split('/')[-1].split('#')[-1] # local name
-    
-    def properties(self, uri=None):
-        if uri is None:
-            uri = self.uri
-        propvals = OrderedDict() # key: property URIRef, value: list of values
-        props = set([prop for prop in self.graph.predicates(uri, None)
-                     if prop not in (RDF.type, SCHEMA.workExample, SCHEMA.exampleOfWork)])
-        for prop in sorted(props, key=lambda prop: self.property_name(prop).lower()):
-            propname = self.property_name(prop)
-            propvals[propname] = []
-            for obj in self.graph.objects(uri, prop):
-                if isinstance(obj, URIRef) or self.graph.value(obj, SCHEMA.name, None, any=True) is not None:
-                    val = Resource(obj, self.graph)
-                elif isinstance(obj, BNode):
-                    val = self.properties(obj)
-                else:
-                    val = obj
-                propvals[propname].append(val)
-            propvals[propname].sort(key=lambda val: str(val).lower())
-        return propvals
-    
     def has_instances(self):
         return False
     
-    def has_works_about(self):
-        return self.graph.value(None, SCHEMA.about, self.uri, any=True) is not None
-    
-    def works_about(self):
-        works = [Work(work, self.graph) for work in self.graph.subjects(SCHEMA.about, self.uri)]
-        works.sort(key=lambda w: w.sort_key())
-        return works
+    def work_list(self, name, page=1):
+        """return one page of the works linked to this resource, see WORK_LISTS"""
+        key = (name, page)
+        if key not in self._work_lists:
+            self._work_lists[key] = WorkList(self.uri, WORK_LISTS[name], page)
+        return self._work_lists[key]
 
-    def has_authored_works(self):
-        return False
+    def load_work_lists(self):
+        """load the first pages of all work lists of this resource, querying
+        those not cached concurrently; return them by list name
+
+        Like the subqueries of a graph, the queries are admitted together."""
+        names = [name for name in self.work_lists if (name, 1) not in self._work_lists and
+                 WorkList.cache_key(self.uri, WORK_LISTS[name]) not in list_cache]
+        if len(names) > 1:
+            start = time.monotonic()
+            with admission.limiter('WorkList').slot(len(names)):
+                deadline = start + sparql.timeout
+                futures = [(name, fetch_pool.submit(fetch_work_list, self.uri, WORK_LISTS[name], deadline))
+                           for name in names]
+                for name, future in futures:
+                    try:
+                        work_list, stale = future.result(timeout=max(deadline - time.monotonic(), 0))
+                    except FutureTimeout:
+                        future.cancel()
+                        raise QueryTimeout("%s work list of %s exceeded its deadline" % (name, self.uri))
+                    if stale:
+                        # served_stale() is per thread, pass it on to the requesting one
+                        mark_stale()
+                    self._work_lists[(name, 1)] = work_list
+        return OrderedDict((name, self.work_list(name)) for name in self.work_lists)
+
+    def work_list_url(self, name):
+        return "%s/%s" % (self.url().rstrip('/'), name)
 
-    def has_contributed_works(self):
-        return False
-      
     def is_agent(self):
         return False
     
+    def stream(self, fmt):
+        """return a generator yielding the graph serialized as 'nt' or 'turtle' in chunks"""
+        if fmt == 'nt':
+            return iter_ntriples(self.graph)
+        if fmt == 'turtle':
+            return iter_turtle(self.graph, TURTLE_PREFIXES)
+        raise ValueError("streaming not supported for format %s" % fmt)
+
     def serialize(self, fmt):
         if fmt == 'json-ld':
-            context = {"@vocab": SCHEMA, "rdau": RDAU, "skos": SKOS, "skos:prefLabel": {"@container": "@language"} }
+            context = {"@vocab": str(SCHEMA), "rdau": str(RDAU), "skos": str(SKOS), "skos:prefLabel": {"@container": "@language"} }
             return self.graph.serialize(format='json-ld', context=context)
         return self.graph.serialize(format=fmt)
         
 
 class Work (Resource):
-    query = """
+    download_query = """
       %(prefixes)s
-      
+
       CONSTRUCT {
         <%(uri)s> ?p ?o .
         ?o schema:name ?oname ;
            skos:prefLabel ?olabel .
-        ?wab schema:about <%(uri)s> ;
-             schema:name ?wabname .
         ?inst ?instprop ?instval .
-        ?instval schema:name ?instvalName ;
-                 skos:prefLabel ?instvalLabel .
         ?id ?idprop ?idval .
         ?pubEvent schema:location ?pubPlace ;
                   schema:organizer ?org .
-        ?pubPlace schema:name ?pubPlaceName .
-        ?org schema:name ?orgName .
       }
       WHERE {
         {
@@ -212,98 +580,123 @@ class Work (Resource):
             { ?o schema:name ?oname }
             UNION
             { ?o skos:prefLabel ?olabel }
+            FILTER(isBlank(?o))
           }
         }
         UNION
-        { # works about
-          ?wab schema:about <%(uri)s> ;
-               schema:name ?wabname .
-        }
-        UNION
         { # instances
-          { <%(uri)s> schema:workExample ?inst }
-          OPTIONAL {
-            {
-              ?inst ?instprop ?instval .
-              OPTIONAL {
-                { ?instval schema:name ?instvalName }
-                UNION
-                { ?instval skos:prefLabel ?instvalLabel }
-              }
-            }
-            UNION
-            { # identifiers
-              ?inst schema:identifier ?id .
-              ?id ?idprop ?idval .
-            }
-            UNION
-            { # publication events
-              ?inst schema:publication ?pubEvent .
-              OPTIONAL {
-                ?pubEvent schema:location ?pubPlace .
-                ?pubPlace schema:name ?pubPlaceName .
-              }
-              OPTIONAL {
-                ?pubEvent schema:organizer ?org .
-                ?org schema:name ?orgName .
-              }
-            }
+          <%(uri)s> schema:workExample ?inst .
+          {
+            ?inst ?instprop ?instval .
+          }
+          UNION
+          { # identifiers
+            ?inst schema:identifier ?id .
+            ?id ?idprop ?idval .
+          }
+          UNION
+          { # publication events
+            ?inst schema:publication ?pubEvent .
+            OPTIONAL { ?pubEvent schema:location ?pubPlace }
+            OPTIONAL { ?pubEvent schema:organizer ?org }
           }
         }
       }
     """
 
+    download_paths = (SCHEMA.workExample, SCHEMA.identifier, SCHEMA.publication)
+
+    subqueries = Resource.subqueries + (
+        ('instances', """
+          %(prefixes)s
+
+          CONSTRUCT {
+            ?inst ?instprop ?instval .
+            ?instval schema:name ?instvalName ;
+                     skos:prefLabel ?instvalLabel .
+          }
+          WHERE {
+            <%(uri)s> schema:workExample ?inst .
+            ?inst ?instprop ?instval .
+            FILTER(?instprop NOT IN (schema:identifier, schema:publication))
+            OPTIONAL {
+              { ?instval schema:name ?instvalName }
+              UNION
+              { ?instval skos:prefLabel ?instvalLabel }
+            }
+          }
+        """, False),
+        ('identifiers', """
+          %(prefixes)s
+
+          CONSTRUCT {
+            ?inst schema:identifier ?id .
+            ?id ?idprop ?idval .
+          }
+          WHERE {
+            <%(uri)s> schema:workExample ?inst .
+            ?inst schema:identifier ?id .
+            OPTIONAL { ?id ?idprop ?idval }
+          }
+        """, False),
+        ('publications', """
+          %(prefixes)s
+
+          CONSTRUCT {
+            ?inst schema:publication ?pubEvent .
+            ?pubEvent schema:location ?pubPlace ;
+                      schema:organizer ?org .
+            ?pubPlace schema:name ?pubPlaceName .
+            ?org schema:name ?orgName .
+          }
+          WHERE {
+            <%(uri)s> schema:workExample ?inst .
+            ?inst schema:publication ?pubEvent .
+            OPTIONAL {
+              ?pubEvent schema:location ?pubPlace .
+              ?pubPlace schema:name ?pubPlaceName .
+            }
+            OPTIONAL {
+              ?pubEvent schema:organizer ?org .
+              ?org schema:name ?orgName .
+            }
+          }
+        """, False),
+    )
+
     def has_instances(self):
         return self.graph.value(self.uri, SCHEMA.workExample, None, any=True) is not None
 
-    def instances(self):
-        insts = [Instance(inst, self.graph) for inst in self.graph.objects(self.uri, SCHEMA.workExample)]
-        insts.sort(key=lambda inst: inst.sort_key())
-        return insts
-
 class Instance (Resource):
+    work_query = """
+      PREFIX schema: <http://schema.org/>
+      SELECT ?work
+      WHERE { <%(uri)s> schema:exampleOfWork ?work }
+      LIMIT 1
+    """
 
-    def edition_info(self):
-        date_published = self.graph.value(self.uri, SCHEMA.datePublished, None)
-        if date_published is None:
-          date_published = "-"
-        publisher_uri = self.graph.value(self.uri, SCHEMA.publisher, None)
-        if publisher_uri is not None:
-          publisher_name = Resource(publisher_uri, self.graph).name()
-          name = "%s : %s" % (date_published, publisher_name)
-        else:
-          name = date_published
-        if (self.uri, SCHEMA.bookFormat, SCHEMA.EBook) in self.graph:
-            name += ", e-book"
-        return name
-    
-    def sort_key(self):
-        return self.edition_info().lower()
-
-    def finna_url(self):
-        for ident in self.graph.objects(self.uri, SCHEMA.identifier):
-            property_id = self.graph.value(ident, SCHEMA.propertyID, None)
-            if str(property_id) == 'FI-FENNI':
-                finna_id = self.graph.value(ident, SCHEMA.value, None)
-                if finna_id is not None:
-                    return "https://finna.fi/Record/fennica.%s" % finna_id
-        return None
-    
-    def get_work(self):
-        work_uri = self.graph.value(self.uri, SCHEMA.exampleOfWork, None, any=True)
-        return Work(work_uri, self.graph)
+    def work_uri(self):
+        """return the URI of the work of this instance, or None if there is none
+
+        Doesn't load the graph of the instance unless it is already cached."""
+        if self.is_cached():
+            return self.graph.value(self.uri, SCHEMA.exampleOfWork, None, any=True)
+        return instance_work_cache.get(str(self.uri), self.query_work_uri)
+
+    def query_work_uri(self):
+        bindings = timed_query('InstanceWork', sparql.select, self.work_query % {'uri': self.uri})["results"]["bindings"]
+        return URIRef(bindings[0]['work']['value']) if bindings else None
 
 class Collection (Work):
     pass
 
 class Agent (Resource):
-    query = """
+    work_lists = ('authored', 'contributed', 'about')
+
+    reverse_query = """
       %(prefixes)s
-      
+
       CONSTRUCT {
-        <%(uri)s> ?p ?o .
-        ?o schema:name ?oname ;
-           skos:prefLabel ?olabel .
         ?wab schema:about <%(uri)s> ;
              schema:name ?wabname .
         ?wau schema:author <%(uri)s> ;
@@ -312,15 +705,6 @@ class Agent (Resource):
              schema:name ?wconame .
       }
       WHERE {
-        {
-          <%(uri)s> ?p ?o .
-          OPTIONAL {
-            { ?o schema:name ?oname }
-            UNION
-            { ?o skos:prefLabel ?olabel }
-          }
-        }
-        UNION
         { # works about
           ?wab schema:about <%(uri)s> ;
                schema:name ?wabname .
@@ -341,22 +725,6 @@ class Agent (Resource):
     def is_agent(self):
         return True
 
-    def has_authored_works(self):
-        return self.graph.value(None, SCHEMA.author, self.uri, any=True) is not None
-    
-    def authored_works(self):
-        works = [Work(work, self.graph) for work in self.graph.subjects(SCHEMA.author, self.uri)]
-        works.sort(key=lambda work: work.sort_key())
-        return works
-
-    def has_contributed_works(self):
-        return self.graph.value(None, SCHEMA.contributor, self.uri, any=True) is not None
-    
-    def contributed_works(self):
-        works = [Work(work, self.graph) for work in self.graph.subjects(SCHEMA.contributor, self.uri)]
-        works.sort(key=lambda work: work.sort_key())
-        return works
-
 class Person (Agent):
     pass
 
@@ -370,15 +738,119 @@ class ConceptScheme (Resource):
     pass
 
 
+class WorkList:
+    """one page of the works linked to a resource via a property, ordered by name
+
+    The total number of works is counted in the same query as the page, one
+    row holding the count and the others the works of the page."""
+
+    query = """
+    PREFIX schema: <http://schema.org/>
+
+    SELECT ?count ?work ?name
+    WHERE {
+      {
+        SELECT (COUNT(DISTINCT ?w) AS ?count)
+        WHERE {
+          ?w <%(prop)s> <%(uri)s> ;
+            schema:name ?wn .
+        }
+      }
+      UNION
+      {
+        SELECT ?work (MIN(STR(?n)) AS ?name)
+        WHERE {
+          ?work <%(prop)s> <%(uri)s> ;
+            schema:name ?n .
+        }
+        GROUP BY ?work
+        ORDER BY LCASE(?name) ?work
+        LIMIT %(limit)d
+        OFFSET %(offset)d
+      }
+    }
+    """
+
+    def __init__(self, uri, prop, page=1, page_size=None, deadline=None):
+        self.uri = uri
+        self.prop = prop
+        self.page = page
+        self.page_size = page_size or WORK_LIST_PAGE_SIZE
+        # if set, the query is already admitted and must complete by deadline
+        self.deadline = deadline
+        self.total, self.bindings = list_cache.get(self.cache_key(uri, prop, page, self.page_size),
+                                                   self.query_for_page)
+
+    @staticmethod
+    def cache_key(uri, prop, page=1, page_size=None):
+        return ('WorkList', str(uri), str(prop), page, page_size or WORK_LIST_PAGE_SIZE)
+
+    def query_for_page(self):
+        query = self.query % {'uri': self.uri, 'prop': self.prop,
+                              'limit': self.page_size, 'offset': (self.page - 1) * self.page_size}
+        if self.deadline is None:
+            results = timed_query('WorkList', sparql.select, query)
+        else:
+            results = query_until('WorkList', self.deadline, sparql.select, query)
+        total = 0
+        bindings = []
+        for binding in results["results"]["bindings"]:
+            if 'count' in binding:
+                total = int(binding['count']['value'])
+            elif 'work' in binding:
+                bindings.append(binding)
+        # rows of a union come in no particular order
+        bindings.sort(key=lambda b: (b['name']['value'].lower(), b['work']['value']))
+        return (total, bindings)
+
+    def digest(self):
+        h = hashlib.sha1(str(self.total).encode('utf-8'))
+        for b in self.bindings:
+            h.update(("%s %s\n" % (b['work']['value'], b['name']['value'])).encode('utf-8'))
+        return h.hexdigest()
+
+    def works(self):
+        graph = Graph()
+        for b in self.bindings:
+            graph.add((URIRef(b['work']['value']), SCHEMA.name, Literal(b['name']['value'])))
+        return [Work(URIRef(b['work']['value']), graph) for b in self.bindings]
+
+    def pages(self):
+        return max(1, (self.total + self.page_size - 1) // self.page_size)
+
+    def has_previous(self):
+        return self.page > 1
+
+    def has_next(self):
+        return self.page < self.pages()
+
+
+def fetch_work_list(uri, prop, deadline):
+    """return the first page of a work list and whether it is stale, for
+    loading it on a fetch thread"""
+    reset_stale()
+    return (WorkList(uri, prop, deadline=deadline), served_stale())
+
+
+def binding_labels(bindings):
+    """return a LabelIndex of the matched literals in text search results"""
+    return LabelIndex((b['uri']['value'], 0, Literal(b['literal']['value'], lang=b['literal'].get('xml:lang')))
+                      for b in bindings)
+
 class SearchResult:
-    def __init__(self, binding):
+    def __init__(self, binding, labels=None):
         self.binding = binding
+        self.labels = labels
     
     def uri(self):
         return uri_to_url(self.binding['uri']['value'])
     
     def name(self):
-        return self.binding['literal']['value']
+        """the preferred one of the literals matched for this resource"""
+        name = self.binding['literal']['value']
+        if self.labels is not None:
+            name = str(self.labels.name(self.binding['uri']['value'], name))
+        return name
     
     def typename(self):
         if 'type' in self.binding:
@@ -396,33 +868,139 @@ class Search:
     
     SELECT *
     WHERE {
-      (?uri ?score ?literal) text:query ('%(query_string)s' 100) .
+      (?uri ?score ?literal) text:query ('%(query_string)s' %(search_limit)d) .
       ?uri a ?type .
       VALUES ?type { bf:Work schema:Person schema:Organization skos:Concept }
       FILTER(isIRI(?uri))
     }
     ORDER BY DESC(?score)
-    LIMIT %(items_per_page)d
     """
     
-    def __init__(self, query_string, items_per_page=20):
+    def __init__(self, query_string, items_per_page=20, start_index=1, start_page=1):
         self.query_string = query_string
         self.items_per_page = items_per_page
+        # OpenSearch startIndex and startPage are both 1-based
+        self.start_index = start_index + (start_page - 1) * items_per_page
 
-        sparql = SPARQLWrapper(ENDPOINT)
-        sparql.setQuery(self.query % {'query_string': self.formatted_query_string(), 'items_per_page': self.items_per_page})
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        self.bindings = results["results"]["bindings"]
+        # all pages are served from one ranked window of results
+        self.window = search_cache.get(self.formatted_query_string(), self.query_window)
+        offset = self.start_index - 1
+        self.bindings = self.window[offset:offset + items_per_page]
     
     def formatted_query_string(self):
-        return " ".join(["+%s" % word for word in self.query_string.split()])
+        return " ".join(["+%s" % word for word in self.query_string.lower().split()])
+    
+    def query_window(self):
+        results = timed_query('Search', sparql.select,
+                              self.query % {'query_string': self.formatted_query_string(), 'search_limit': SEARCH_WINDOW})
+        return results["results"]["bindings"]
     
     def total_results(self):
-        return len(self.bindings)
+        return len(self.window)
     
     def results(self):
-        return [SearchResult(binding) for binding in self.bindings]
+        labels = binding_labels(self.window)
+        return [SearchResult(binding, labels) for binding in self.bindings]
+
+    def start_page(self):
+        return (self.start_index - 1) // self.items_per_page + 1
+
+    def has_previous(self):
+        return self.start_index > 1
+
+    def previous_index(self):
+        return max(self.start_index - self.items_per_page, 1)
+
+    def has_next(self):
+        return self.start_index - 1 + self.items_per_page < len(self.window)
+
+    def next_index(self):
+        return self.start_index + self.items_per_page
+
+class Suggestions:
+    """autocomplete suggestions for a partially typed query
+
+    The last word of the query is treated as a prefix. All matched
+    (resource, literal) pairs are cached by normalized query; when a
+    shorter prefix of the query is cached with all its matches, the matches
+    are filtered from those instead of querying the endpoint again. Each
+    resource is suggested once, with its best ranked matching literal."""
+
+    query = """
+    PREFIX schema: <http://schema.org/>
+    PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+    PREFIX text: <http://jena.apache.org/text#>
+    PREFIX bf: <http://id.loc.gov/ontologies/bibframe/>
+
+    SELECT ?uri ?score ?literal ?type
+    WHERE {
+      (?uri ?score ?literal) text:query ('%(query_string)s' %(search_limit)d) .
+      OPTIONAL {
+        ?uri a ?type .
+        VALUES ?type { bf:Work schema:Person schema:Organization skos:Concept }
+      }
+    }
+    ORDER BY DESC(?score)
+    """
+
+    def __init__(self, query_string, limit=10):
+        self.query_string = self.normalize(query_string)
+        self.limit = limit
+        if len(self.query_string) < SUGGEST_MIN_CHARS:
+            self.bindings = []
+        else:
+            complete, matches = suggest_cache.get(self.query_string, self.load)
+            self.bindings = self.first_per_resource(matches)[:limit]
+
+    @staticmethod
+    def normalize(query_string):
+        # keep only word characters, so the text index query syntax can't be broken
+        return " ".join(re.findall(r'\w+', query_string.lower()))
+
+    @staticmethod
+    def first_per_resource(bindings):
+        seen = set()
+        first = []
+        for binding in bindings:
+            uri = binding['uri']['value']
+            if uri not in seen:
+                seen.add(uri)
+                first.append(binding)
+        return first
+
+    def load(self):
+        """return (complete, matches) for the query, matches being the
+        bindings of all suggestible (resource, literal) hits in rank order"""
+        for end in range(len(self.query_string) - 1, SUGGEST_MIN_CHARS - 1, -1):
+            cached = suggest_cache.peek(self.query_string[:end])
+            if cached is not None and cached[0]:
+                return (True, [b for b in cached[1] if self.matches(b['literal']['value'])])
+
+        query_string = " ".join(["+%s" % word for word in self.query_string.split()]) + "*"
+        results = timed_query('Suggestions', sparql.select,
+                              self.query % {'query_string': query_string, 'search_limit': SUGGEST_SEARCH_LIMIT})
+        hits = set()
+        matches = []
+        for binding in results["results"]["bindings"]:
+            hit = (binding['uri']['value'], binding['literal']['value'])
+            if hit in hits:
+                # another type of the same resource
+                continue
+            hits.add(hit)
+            if 'type' in binding and binding['uri']['type'] == 'uri':
+                matches.append(binding)
+        # if the index returned fewer hits than asked for, these are all the matches
+        return (len(hits) < SUGGEST_SEARCH_LIMIT, matches)
+
+    def matches(self, literal):
+        tokens = re.findall(r'\w+', literal.lower())
+        words = self.query_string.split()
+        return all(word in tokens for word in words[:-1]) and \
+            any(token.startswith(words[-1]) for token in tokens)
+
+    def results(self):
+        labels = binding_labels(self.bindings)
+        return [SearchResult(binding, labels) for binding in self.bindings]
 
 class Collections:
     query = """
@@ -437,11 +1015,11 @@ class Collections:
     """
     
     def __init__(self):
-        sparql = SPARQLWrapper(ENDPOINT)
-        sparql.setQuery(self.query)
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        self.bindings = results["results"]["bindings"]
+        self.bindings = collections_data.get()
+
+    @classmethod
+    def load(cls):
+        return timed_query(cls.__name__, sparql.select, cls.query)["results"]["bindings"]
 
     def list_collections(self):
         return [{'uri': b['uri']['value'],
@@ -464,17 +1042,21 @@ class ConceptSchemes:
     """
     
     def __init__(self):
-        sparql = SPARQLWrapper(ENDPOINT)
-        sparql.setQuery(self.query)
-        sparql.setReturnFormat(JSON)
-        results = sparql.query().convert()
-        self.bindings = results["results"]["bindings"]
+        self.bindings = conceptschemes_data.get()
+
+    @classmethod
+    def load(cls):
+        return timed_query(cls.__name__, sparql.select, cls.query)["results"]["bindings"]
 
     def list_concept_schemes(self):
         return [{'uri': b['uri']['value'],
                  'url': uri_to_url(b['uri']['value']),
                  'title': b['title']['value']}
                 for b in self.bindings]
+
+# the lists on the index page, shared by all requests
+collections_data = RefreshingValue(Collections.load, INDEX_REFRESH_INTERVAL, INDEX_RETRY_INTERVAL)
+conceptschemes_data = RefreshingValue(ConceptSchemes.load, INDEX_REFRESH_INTERVAL, INDEX_RETRY_INTERVAL)
                  
 
 class ExampleQueries:
@@ -0,0 +1,108 @@
+"""Fast N-Triples parser.
+
+Parsing the endpoint responses with rdflib's parsers takes a large share of
+the time spent on big resources. N-Triples as written by the endpoint (one
+statement per line, terms separated by single spaces) can instead be split
+with plain string operations. URIs and literals are interned, so repeated
+predicates, classes and values share one term object instead of being
+constructed again for every statement.
+"""
+
+import re
+
+from rdflib import URIRef, BNode, Literal
+
+# interned terms, shared by all parses; cleared when they grow larger than this
+MAX_INTERNED = 100000
+_uris = {}
+_literals = {}
+
+ESCAPE = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|[tbnrf"\'\\])')
+ESCAPES = {'t': '\t', 'b': '\b', 'n': '\n', 'r': '\r', 'f': '\f', '"': '"', "'": "'", '\\': '\\'}
+
+
+def _unescape_match(match):
+    esc = match.group(1)
+    if esc[0] in 'uU':
+        return chr(int(esc[1:], 16))
+    return ESCAPES[esc]
+
+
+def unescape(text):
+    if '\\' not in text:
+        return text
+    return ESCAPE.sub(_unescape_match, text)
+
+
+def uri(text):
+    """return the interned URIRef for an N-Triples IRI including the angle brackets"""
+    term = _uris.get(text)
+    if term is None:
+        if len(_uris) >= MAX_INTERNED:
+            _uris.clear()
+        term = _uris[text] = URIRef(unescape(text[1:-1]))
+    return term
+
+
+def literal(text):
+    """return the interned Literal for an N-Triples literal"""
+    term = _literals.get(text)
+    if term is None:
+        end = text.rindex('"')
+        value = unescape(text[1:end])
+        suffix = text[end + 1:]
+        if not suffix:
+            term = Literal(value)
+        elif suffix[0] == '@':
+            term = Literal(value, lang=suffix[1:])
+        elif suffix.startswith('^^<'):
+            term = Literal(value, datatype=uri(suffix[2:]))
+        else:
+            raise ValueError("invalid literal %s" % text)
+        if len(_literals) >= MAX_INTERNED:
+            _literals.clear()
+        _literals[text] = term
+    return term
+
+
+def parse_ntriples(data, graph):
+    """parse N-Triples (bytes) into graph and return the graph
+
+    Blank nodes get new identifiers, so parsing several documents into the
+    same graph doesn't mix up their blank nodes."""
+    bnodes = {}
+    add = graph.add
+    for lineno, line in enumerate(data.decode('utf-8').split('\n'), 1):
+        if not line or line[0] == '#':
+            continue
+        try:
+            subj, pred, obj = line.split(' ', 2)
+            obj = obj.rstrip()
+            if obj[-1] != '.':
+                raise ValueError("missing final .")
+            obj = obj[:-1].rstrip()
+
+            if subj[0] == '<':
+                s = uri(subj)
+            elif subj.startswith('_:'):
+                s = bnodes.get(subj)
+                if s is None:
+                    s = bnodes[subj] = BNode()
+            else:
+                raise ValueError("invalid subject %s" % subj)
+            p = uri(pred)
+            first = obj[0]
+            if first == '<':
+                o = uri(obj)
+            elif first == '"':
+                o = literal(obj)
+            elif obj.startswith('_:'):
+                o = bnodes.get(obj)
+                if o is None:
+                    o = bnodes[obj] = BNode()
+            else:
+                raise ValueError("invalid object %s" % obj)
+        except (ValueError, IndexError) as e:
+            raise ValueError("invalid N-Triples on line %d: %s" % (lineno, e))
+        add((s, p, o))
+    return graph
@@ -0,0 +1,255 @@
+"""Pre-render resource pages and RDF representations to static files.
+
+Resources are enumerated from the endpoint with paged SELECT queries and
+rendered by a pool of worker processes into a directory tree mirroring
+the routes, e.g. /bib/me/W00009584701 as bib/me/W00009584701.html,
+bib/me/W00009584701.ttl and so on, for a web server or CDN to serve.
+Instances only get their RDF representations, as their pages redirect to
+their works.
+
+A manifest database in the output directory records an ETag of each
+resource, which changes with its graphs, its work lists and the
+templates. Resources whose ETag hasn't changed since they were last
+rendered are not written again. An interrupted run is resumed on the next
+start, skipping the resources it already finished, unless --restart is
+given.
+
+    python -m biblodui.prerender /var/www/static --types work,person
+"""
+
+import argparse
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from biblodui import app, model, views
+from biblodui.endpoint import SPARQLClient
+from biblodui.rendercache import RenderCache
+
+PRERENDER_PROCESSES = os.cpu_count() or 1
+PRERENDER_CHUNK_SIZE = 50 # resources per task given to a worker process
+PRERENDER_PAGE_SIZE = 10000 # URIs per enumeration query
+PRERENDER_FORMATS = ('html', 'ttl', 'nt', 'rdf', 'json')
+PRERENDER_BASE_URL = 'http://data.nationallibrary.fi/'
+MANIFEST_NAME = '.prerender.db'
+
+# resources whose pages redirect elsewhere (see views.bib_instance), so
+# that only their RDF representations are rendered
+REDIRECTED_CLASSES = (model.Instance,)
+
+# resource type -> (graph pattern selecting ?uri, URI prefix)
+TYPES = {
+    'work': ('?uri a bf:Work', 'http://urn.fi/URN:NBN:fi:bib:me:W'),
+    'instance': ('?uri schema:exampleOfWork ?work', 'http://urn.fi/URN:NBN:fi:bib:me:I'),
+    'person': ('?uri a schema:Person', 'http://urn.fi/URN:NBN:fi:'),
+    'organization': ('?uri a schema:Organization', 'http://urn.fi/URN:NBN:fi:'),
+    'concept': ('?uri a skos:Concept', 'http://www.yso.fi/onto/yso/p'),
+}
+
+ENUMERATE_QUERY = """
+  PREFIX schema: <http://schema.org/>
+  PREFIX bf: <http://id.loc.gov/ontologies/bibframe/>
+  PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+  SELECT DISTINCT ?uri
+  WHERE {
+    %(pattern)s .
+    FILTER(isIRI(?uri) && STRSTARTS(STR(?uri), "%(prefix)s") && STR(?uri) > "%(after)s")
+  }
+  ORDER BY STR(?uri)
+  LIMIT %(limit)d
+"""
+
+
+def enumerate_uris(typename, page_size=PRERENDER_PAGE_SIZE):
+    """yield the URIs of resources of a type, in URI order"""
+    pattern, prefix = TYPES[typename]
+    after = ''
+    while True:
+        bindings = model.timed_query('Prerender', model.sparql.select, ENUMERATE_QUERY % {
+            'pattern': pattern, 'prefix': prefix, 'after': after, 'limit': page_size})["results"]["bindings"]
+        for binding in bindings:
+            uri = binding['uri']['value']
+            # only resources that have a page of their own
+            if model.uri_to_url(uri) != uri:
+                yield uri
+        if len(bindings) < page_size:
+            return
+        after = bindings[-1]['uri']['value']
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Manifest:
+    """rendered resources and runs, kept in a SQLite database"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS page (uri TEXT PRIMARY KEY, etag TEXT, rendered REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS run (started REAL, finished REAL)')
+        self.db.commit()
+
+    def start_run(self, restart=False):
+        """return the start time of the unfinished run to resume, or of a new run"""
+        last = self.db.execute('SELECT rowid, started, finished FROM run ORDER BY started DESC LIMIT 1').fetchone()
+        if last is not None and last[2] is None and not restart:
+            self.run_id, self.started = last[0], last[1]
+            return self.started
+        self.started = time.time()
+        self.run_id = self.db.execute('INSERT INTO run (started) VALUES (?)', (self.started,)).lastrowid
+        self.db.commit()
+        return self.started
+
+    def finish_run(self):
+        self.db.execute('UPDATE run SET finished = ? WHERE rowid = ?', (time.time(), self.run_id))
+        self.db.commit()
+
+    def lookup(self, uris):
+        """return {uri: (etag, rendered)} for the given URIs"""
+        rows = self.db.execute('SELECT uri, etag, rendered FROM page WHERE uri IN (%s)' % ','.join('?' * len(uris)), uris)
+        return {uri: (etag, rendered) for uri, etag, rendered in rows}
+
+    def record(self, results):
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO page (uri, etag, rendered) VALUES (?, ?, ?)',
+                            [(uri, etag, now) for uri, status, etag in results if etag is not None])
+        self.db.commit()
+
+
+def init_worker(endpoint):
+    """set up a worker process: own endpoint connections and no render cache"""
+    if endpoint:
+        model.sparql = SPARQLClient(endpoint, model.ENDPOINT_POOL_SIZE,
+                                    model.ENDPOINT_CONNECT_TIMEOUT, model.ENDPOINT_READ_TIMEOUT)
+    views.render_cache = RenderCache(max_bytes=0)
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def render_chunk(outdir, uris, etags, formats, base_url):
+    """render resources in a worker process; return [(uri, status, ETag)]
+
+    Resources whose ETag equals the one in etags are skipped."""
+    results = []
+    for uri in uris:
+        try:
+            res = model.get_resource(uri)
+            download = res.for_download()
+            res_formats = [fmt for fmt in formats if fmt != 'html' or not isinstance(res, REDIRECTED_CLASSES)]
+            # enumerated resources exist, no need to ask before loading the graph
+            if len((res if 'html' in res_formats else download).graph) == 0:
+                results.append((uri, 'missing', None))
+                continue
+            html_etag = views.resource_validators(res, 'html')[0] if 'html' in res_formats else ''
+            etag = hashlib.sha1(("%s %s %s" % (html_etag, download.digest(), ' '.join(res_formats))).encode('utf-8')).hexdigest()
+            if etag == etags.get(uri):
+                results.append((uri, 'unchanged', etag))
+                continue
+            path = model.uri_to_url(uri)
+            with app.test_request_context(path, base_url=base_url):
+                for fmt in res_formats:
+                    body = views.render_body(res if fmt == 'html' else download, views.FORMATS[fmt][0])
+                    if not isinstance(body, bytes):
+                        body = b''.join(body)
+                    write_file(os.path.join(outdir, '%s.%s' % (path.lstrip('/'), fmt)), body)
+            results.append((uri, 'rendered', etag))
+        except Exception as e:
+            results.append((uri, 'failed: %s' % e, None))
+        finally:
+            # graphs are not needed again, keep the cache small
+            model.graph_cache.invalidate(model.get_resource(uri).cache_key())
+            model.graph_cache.invalidate(model.get_resource(uri).for_download().cache_key())
+    return results
+
+
+def prerender(outdir, types, formats=PRERENDER_FORMATS, processes=PRERENDER_PROCESSES,
+              chunk_size=PRERENDER_CHUNK_SIZE, endpoint=None, base_url=PRERENDER_BASE_URL,
+              restart=False, force=False, log=sys.stderr):
+    """pre-render all resources of the given types and return counts by status"""
+    os.makedirs(outdir, exist_ok=True)
+    manifest = Manifest(os.path.join(outdir, MANIFEST_NAME))
+    started = manifest.start_run(restart)
+    counts = {}
+    # spawned workers don't share the endpoint connections of this process
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker,
+                             initargs=(endpoint,)) as pool:
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                results = future.result()
+                manifest.record(results)
+                for uri, status, etag in results:
+                    kind = status.split(':')[0]
+                    counts[kind] = counts.get(kind, 0) + 1
+                    if kind == 'failed':
+                        print("%s %s" % (uri, status), file=log)
+
+        for typename in types:
+            for uris in chunked(enumerate_uris(typename), chunk_size):
+                known = manifest.lookup(uris)
+                # finished by the run being resumed
+                todo = [uri for uri in uris if uri not in known or known[uri][1] < started]
+                counts['resumed'] = counts.get('resumed', 0) + len(uris) - len(todo)
+                if not todo:
+                    continue
+                etags = {} if force else {uri: known[uri][0] for uri in todo if uri in known}
+                pending.add(pool.submit(render_chunk, outdir, todo, etags, formats, base_url))
+                # bound the number of queued tasks
+                if len(pending) >= processes * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            print("%s: done enumerating, %s" % (typename, counts), file=log)
+        collect(wait(pending)[0])
+    manifest.finish_run()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pre-render resource pages to static files')
+    parser.add_argument('outdir', help='directory to write the files to')
+    parser.add_argument('--types', default=','.join(TYPES), help='comma separated resource types (default: %(default)s)')
+    parser.add_argument('--formats', default=','.join(PRERENDER_FORMATS), help='comma separated formats (default: %(default)s)')
+    parser.add_argument('--processes', type=int, default=PRERENDER_PROCESSES)
+    parser.add_argument('--chunk-size', type=int, default=PRERENDER_CHUNK_SIZE)
+    parser.add_argument('--endpoint', help='SPARQL endpoint URL (default: %s)' % model.ENDPOINT)
+    parser.add_argument('--base-url', default=PRERENDER_BASE_URL, help='URL root the pages are served from')
+    parser.add_argument('--restart', action='store_true', help="don't resume an interrupted run")
+    parser.add_argument('--force', action='store_true', help='render resources even if unchanged')
+    args = parser.parse_args(argv)
+
+    types = args.types.split(',')
+    formats = args.formats.split(',')
+    for name in types:
+        if name not in TYPES:
+            parser.error("unknown type %s" % name)
+    for fmt in formats:
+        if fmt not in views.FORMATS:
+            parser.error("unknown format %s" % fmt)
+    if args.endpoint:
+        init_worker(args.endpoint)
+    counts = prerender(args.outdir, types, formats, args.processes, args.chunk_size,
+                       args.endpoint, args.base_url, args.restart, args.force)
+    print(", ".join("%s %d" % item for item in sorted(counts.items())))
+
+if __name__ == '__main__':
+    main()
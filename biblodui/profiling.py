@@ -0,0 +1,197 @@
+"""Profiling of single requests and sampled traffic.
+
+A request is profiled when BIBLODUI_PROFILE_SECRET is set and the request
+carries the secret in the X-Profile header or the profile query parameter.
+The profile covers the request thread, from the first before_request hook
+to the end of the response body, and is written to BIBLODUI_PROFILE_DIR:
+as a pstats file (cProfile, the default) or, with profile_format=collapsed,
+as stack samples in the collapsed format read by flamegraph tools. A short
+summary is returned in the X-Profile response header. Subqueries run on the
+fetch pool, so their time shows up as waiting in the request thread.
+
+With BIBLODUI_PROFILE_SAMPLE_RATE set, that fraction of all requests is
+also sampled continuously by a background thread, and the stacks of all
+sampled requests are written to samples-<pid>.collapsed in the same
+directory once a minute.
+"""
+
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+PROFILE_SECRET = os.environ.get('BIBLODUI_PROFILE_SECRET')
+PROFILE_DIR = os.environ.get('BIBLODUI_PROFILE_DIR') or tempfile.gettempdir()
+PROFILE_SAMPLE_RATE = float(os.environ.get('BIBLODUI_PROFILE_SAMPLE_RATE') or 0)
+PROFILE_FORMATS = ('pstats', 'collapsed')
+
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+SAMPLE_FLUSH_INTERVAL = 60 # seconds between writes of the sampled stacks
+SUMMARY_FUNCTIONS = 5 # number of functions listed in the X-Profile header
+
+_serial = itertools.count()
+
+
+def requested_format(args, headers):
+    """return the profile format requested with the secret, or None"""
+    if not PROFILE_SECRET:
+        return None
+    token = headers.get('X-Profile') or args.get('profile')
+    if token is None or not hmac.compare_digest(token.encode('utf-8'), PROFILE_SECRET.encode('utf-8')):
+        return None
+    fmt = args.get('profile_format', PROFILE_FORMATS[0])
+    return fmt if fmt in PROFILE_FORMATS else None
+
+
+def frame_name(code):
+    path = code.co_filename.replace(os.sep, '/').rsplit('/', 2)
+    return '%s (%s:%d)' % (code.co_name, '/'.join(path[-2:]), code.co_firstlineno)
+
+
+def collapse(frame):
+    """return the stack of frame as 'outermost;...;innermost'"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def write_collapsed(path, counts):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        for stack, count in counts.most_common():
+            f.write('%s %d\n' % (stack, count))
+    os.replace(tmp, path)
+
+
+class StackSampler:
+    """samples the stacks of watched threads from a background thread
+
+    The thread only takes samples while some thread is watched. Samples of
+    threads unwatched with aggregate=True are added to totals, which are
+    written to path (if given) every flush_interval seconds."""
+
+    def __init__(self, interval=SAMPLE_INTERVAL, path=None, flush_interval=SAMPLE_FLUSH_INTERVAL):
+        self.interval = interval
+        self.path = path
+        self.flush_interval = flush_interval
+        self.totals = Counter()
+        self._samples = {} # key: thread id, value: Counter of collapsed stacks
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def watch(self, thread_id):
+        with self._lock:
+            self._samples[thread_id] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def unwatch(self, thread_id, aggregate=False):
+        """stop sampling thread_id and return its samples"""
+        with self._lock:
+            samples = self._samples.pop(thread_id, Counter())
+            if aggregate and samples:
+                self.totals.update(samples)
+                self._dirty = True
+        return samples
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty or self.path is None:
+                return
+            totals = Counter(self.totals)
+            self._dirty = False
+        write_collapsed(self.path, totals)
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                watched = list(self._samples)
+            if watched:
+                frames = sys._current_frames()
+                stacks = [(thread_id, collapse(frames[thread_id]))
+                          for thread_id in watched if thread_id in frames]
+                with self._lock:
+                    for thread_id, stack in stacks:
+                        if thread_id in self._samples:
+                            self._samples[thread_id][stack] += 1
+                time.sleep(self.interval)
+            else:
+                self._wakeup.wait(self.flush_interval)
+            if time.monotonic() >= next_flush:
+                next_flush = time.monotonic() + self.flush_interval
+                self.flush()
+
+
+# shared by per-request collapsed profiles and sampled traffic
+sampler = StackSampler(path=os.path.join(PROFILE_DIR, 'samples-%d.collapsed' % os.getpid()))
+
+
+def profile_path(fmt):
+    name = 'profile-%s-%d-%d.%s' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid(), next(_serial), fmt)
+    return os.path.join(PROFILE_DIR, name)
+
+
+class RequestProfile:
+    """profile of one request in the given format (see PROFILE_FORMATS)"""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.thread_id = threading.get_ident()
+        self.profiler = cProfile.Profile() if fmt == 'pstats' else None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        else:
+            sampler.watch(self.thread_id)
+
+    def stop(self):
+        """stop profiling, write the profile and return a summary"""
+        elapsed = time.perf_counter() - self.start_time
+        path = profile_path(self.fmt)
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(path)
+            stats = pstats.Stats(self.profiler).stats
+            # key: (file, line, function), value: (calls, total calls, own time, cumulative time, callers)
+            top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:SUMMARY_FUNCTIONS]
+            functions = ['%s (%s:%d) %.1f ms' % (func, os.path.basename(filename), line, value[2] * 1000)
+                         for (filename, line, func), value in top]
+        else:
+            samples = sampler.unwatch(self.thread_id)
+            write_collapsed(path, samples)
+            leaves = Counter()
+            for stack, count in samples.items():
+                leaves[stack.rsplit(';', 1)[-1]] += count
+            functions = ['%s %d' % (leaf, count) for leaf, count in leaves.most_common(SUMMARY_FUNCTIONS)]
+        summary = '%.1f ms; %s; %s' % (elapsed * 1000, os.path.basename(path), ', '.join(functions))
+        return summary.encode('ascii', 'replace').decode('ascii')
+
+
+def sample_request():
+    """start sampling the current request if it is selected by PROFILE_SAMPLE_RATE"""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    thread_id = threading.get_ident()
+    sampler.watch(thread_id)
+    return thread_id
+
+
+def end_sample(thread_id):
+    sampler.unwatch(thread_id, aggregate=True)
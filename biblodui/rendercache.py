@@ -0,0 +1,162 @@
+"""Cache of rendered response bodies, with precompressed variants.
+
+Bodies are keyed by resource URI and variant (a format such as 'html' or
+'ttl', or a negotiated RDF media type) and stored together with the ETag
+they were rendered for, so an entry is only used while the underlying data
+is unchanged. A gzip (and, if the brotli module is installed, brotli)
+compressed copy is made when an entry is stored.
+
+Cached pages can be invalidated in all worker processes by appending URI
+prefixes to an invalidation log, which the workers poll:
+
+    python -m biblodui.rendercache /path/to/invalidation.log /yso/
+    python -m biblodui.rendercache /path/to/invalidation.log http://urn.fi/URN:NBN:fi:bib:me:W00009584101
+    python -m biblodui.rendercache /path/to/invalidation.log --all
+"""
+
+import argparse
+import gzip
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# content encodings in order of preference
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+Rendered = namedtuple('Rendered', ['etag', 'content_type', 'bodies', 'size', 'stored'])
+
+
+class RenderCache:
+    def __init__(self, max_bytes=256 * 1024 * 1024, ttl=3600, max_entry_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = 0
+        self._entries = OrderedDict() # key: (URI, variant), value: Rendered
+        self._lock = threading.Lock()
+
+    def get(self, key, etag):
+        """return the Rendered entry for key if it was rendered for etag, else None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.etag != etag or time.time() - entry.stored > self.ttl):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, etag, body, content_type):
+        """compress and store a body; return the new Rendered entry
+
+        Bodies larger than max_entry_bytes are neither compressed nor
+        stored, the entry only has the identity encoding."""
+        if len(body) > self.max_entry_bytes:
+            return Rendered(etag, content_type, {'identity': body}, len(body), time.time())
+        bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=6)}
+        if brotli is not None:
+            bodies['br'] = brotli.compress(body, quality=6)
+        size = sum(len(b) for b in bodies.values())
+        entry = Rendered(etag, content_type, bodies, size, time.time())
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def _remove(self, key):
+        # must be called with the lock held
+        self._size -= self._entries.pop(key).size
+
+    def invalidate(self, uri_prefix=''):
+        """drop entries for URIs starting with uri_prefix (all entries by default)"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0].startswith(uri_prefix)]:
+                self._remove(key)
+
+    def stats(self):
+        return {'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class InvalidationLog:
+    """append-only file of URI prefixes to invalidate, shared by worker processes"""
+
+    # seconds between checks of the file
+    check_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self._checked = 0
+        self._lock = threading.Lock()
+        # a new process has nothing cached yet, so skip what is already logged
+        try:
+            self._offset = os.path.getsize(path)
+        except OSError:
+            self._offset = 0
+
+    def append(self, uri_prefix):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("%f %s\n" % (time.time(), uri_prefix))
+
+    def poll(self):
+        """return the URI prefixes logged since the last call"""
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return []
+        with self._lock:
+            self._checked = now
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                return []
+            if size < self._offset: # the log was truncated
+                self._offset = 0
+            if size == self._offset:
+                return []
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            # only consume complete lines
+            data = data[:data.rfind(b'\n') + 1]
+            self._offset += len(data)
+        return [line.split(' ', 1)[1] for line in data.decode('utf-8').splitlines() if ' ' in line]
+
+
+def main(argv=None):
+    from biblodui import model
+
+    parser = argparse.ArgumentParser(description='Invalidate cached pages and graphs in all workers')
+    parser.add_argument('log', help='path to the invalidation log')
+    parser.add_argument('prefix', nargs='?', help='URI or URL path prefix, e.g. /yso/')
+    parser.add_argument('--all', action='store_true', help='invalidate everything')
+    args = parser.parse_args(argv)
+    if args.prefix is None and not args.all:
+        parser.error('give a prefix or --all')
+
+    prefix = '' if args.all else model.url_to_uri(args.prefix)
+    InvalidationLog(args.log).append(prefix)
+    if model.disk_cache is not None:
+        print("purged %d entries from the disk cache" % model.disk_cache.purge(prefix))
+    print("invalidated <%s*>" % prefix)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Streaming RDF serializers.
+
+rdflib's serializers build the whole document in memory before anything can
+be sent. These generators instead yield the serialization of a graph in
+chunks of about CHUNK_SIZE bytes, so a response can be streamed to the
+client while it is being produced.
+"""
+
+import hashlib
+import re
+from collections import defaultdict
+
+from rdflib import URIRef, BNode, RDF
+from rdflib.plugins.serializers.nt import _nt_row
+
+CHUNK_SIZE = 64 * 1024
+
+# local names that can safely be written as prefixed names in Turtle
+PN_LOCAL = re.compile(r'^[A-Za-z_][A-Za-z0-9_-]*$')
+
+
+def _chunks(lines):
+    buf = []
+    size = 0
+    for line in lines:
+        buf.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf).encode('utf-8')
+
+
+def iter_ntriples(graph):
+    """yield the graph as N-Triples in chunks of bytes"""
+    return _chunks(_nt_row(triple) for triple in graph)
+
+
+def iter_turtle(graph, prefixes):
+    """yield the graph as Turtle in chunks of bytes
+
+    prefixes is a sequence of (prefix, namespace) pairs to use for
+    abbreviating URIs. Triples are grouped by subject, with subjects in
+    lexical order and blank nodes last."""
+    return _chunks(_turtle_lines(graph, prefixes))
+
+
+def _turtle_lines(graph, prefixes):
+    prefixes = [(prefix, str(ns)) for prefix, ns in prefixes]
+    for prefix, ns in prefixes:
+        yield "@prefix %s: <%s> .\n" % (prefix, ns)
+    yield "\n"
+
+    terms = {} # cache of already formatted URIs
+
+    def fmt(term):
+        if not isinstance(term, URIRef):
+            return term.n3()
+        if term not in terms:
+            if term == RDF.type:
+                terms[term] = 'a'
+            else:
+                terms[term] = term.n3()
+                for prefix, ns in prefixes:
+                    if term.startswith(ns) and PN_LOCAL.match(term[len(ns):]):
+                        terms[term] = "%s:%s" % (prefix, term[len(ns):])
+                        break
+        return terms[term]
+
+    # named resources first, then blank nodes
+    for subj in sorted(set(graph.subjects()), key=lambda subj: (isinstance(subj, BNode), subj)):
+        propvals = defaultdict(list)
+        for pred, obj in graph.predicate_objects(subj):
+            propvals[pred].append(obj)
+        if RDF.type in propvals:
+            preds = [RDF.type] + sorted(pred for pred in propvals if pred != RDF.type)
+        else:
+            preds = sorted(propvals)
+        statements = ["%s %s" % (fmt(pred), ", ".join(fmt(obj) for obj in propvals[pred]))
+                      for pred in preds]
+        yield "%s %s .\n\n" % (fmt(subj), " ;\n    ".join(statements))
+
+
+def graph_digest(graph):
+    """return a SHA-1 hex digest of the graph contents
+
+    Blank node labels differ each time the same data is fetched, so they are
+    all treated as one label; the digest is stable for the same data."""
+    blank = BNode('b')
+    rows = sorted(_nt_row((blank if isinstance(s, BNode) else s, p,
+                           blank if isinstance(o, BNode) else o))
+                  for s, p, o in graph)
+    h = hashlib.sha1()
+    for row in rows:
+        h.update(row.encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,191 @@
+"""Caching proxy for queries sent from the SPARQL query form.
+
+Queries are normalized (comments and insignificant whitespace removed) and
+hashed, and their results are cached per result format. Identical queries
+arriving while one is running share its result. The results of the example
+queries under static/sparql, many of which are expensive aggregates run
+unchanged by many visitors, are computed in a background thread when the
+worker process starts and recomputed every EXAMPLE_REFRESH_INTERVAL
+seconds, so the form shows them without querying the endpoint. With a disk
+cache (BIBLODUI_DISK_CACHE) shared by the worker processes, only the
+process holding its lock computes them, and the others load the results
+from the disk cache.
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+
+from biblodui import app, model
+from biblodui.cache import GraphCache
+
+PROXY_CACHE_SIZE = 1000 # number of query results kept in memory
+PROXY_CACHE_TTL = 600 # seconds
+PROXY_MAX_RESULT_BYTES = 5 * 1024 * 1024 # larger results are not cached
+PROXY_QUERY_TIMEOUT = 30 # seconds, as stated on the query form
+
+EXAMPLE_REFRESH_INTERVAL = 6 * 3600 # seconds between recomputing the example query results
+EXAMPLE_RETRY_INTERVAL = 300 # seconds, after a failed recomputation
+# example results expire only if recomputing them keeps failing
+EXAMPLE_CACHE_TTL = 2 * EXAMPLE_REFRESH_INTERVAL
+EXAMPLE_LOCK = 'sparql-examples' # name of the disk cache lock of the computing process
+
+# result formats of SELECT/ASK and CONSTRUCT/DESCRIBE queries; the first is
+# used when the Accept header doesn't prefer another
+RESULT_FORMATS = ('application/sparql-results+json', 'application/sparql-results+xml',
+                  'text/csv', 'text/tab-separated-values')
+GRAPH_FORMATS = ('text/turtle', 'application/n-triples', 'application/rdf+xml', 'application/ld+json')
+
+# strings and IRIs are kept as they are, comments and whitespace runs are not
+TOKEN = re.compile(r'("""(?:[^"\\]|\\.|"(?!""))*"""'
+                   r"|'''(?:[^'\\]|\\.|'(?!''))*'''"
+                   r'|"(?:[^"\\\n]|\\.)*"'
+                   r"|'(?:[^'\\\n]|\\.)*'"
+                   r'|<[^<>"{}|^`\\\s]*>)'
+                   r'|(?:\s|#[^\n]*)+')
+QUERY_FORM = re.compile(r'^(?:(?:PREFIX\s*[^\s:]*:\s*<[^>]*>|BASE\s*<[^>]*>)\s*)*(SELECT|ASK|CONSTRUCT|DESCRIBE)\b',
+                        re.IGNORECASE)
+
+# query results keyed by (query hash, result format)
+result_cache = GraphCache(PROXY_CACHE_SIZE, PROXY_CACHE_TTL, model.STALE_TTL, model.STALE_ERRORS)
+example_cache = GraphCache(PROXY_CACHE_SIZE, EXAMPLE_CACHE_TTL, model.STALE_TTL, model.STALE_ERRORS)
+
+
+def normalize(query):
+    """return query without comments and with whitespace runs collapsed"""
+    return TOKEN.sub(lambda match: match.group(1) or ' ', query).strip()
+
+
+def result_formats(query):
+    """return the result formats the endpoint can give for query"""
+    match = QUERY_FORM.match(normalize(query))
+    if match is not None and match.group(1).upper() in ('CONSTRUCT', 'DESCRIBE'):
+        return GRAPH_FORMATS
+    return RESULT_FORMATS
+
+
+def cache_key(query, mimetype):
+    return (hashlib.sha1(normalize(query).encode('utf-8')).hexdigest(), mimetype)
+
+
+def run_query(query, mimetype):
+    return model.timed_query('SPARQL', model.sparql.query, query, mimetype, PROXY_QUERY_TIMEOUT)
+
+
+def get_results(query, mimetype):
+    """return the results of query in mimetype as bytes, from the caches if possible"""
+    key = cache_key(query, mimetype)
+    if key in examples.keys:
+        return example_cache.get(key, lambda: load_example(key, query, mimetype))
+    body = result_cache.get(key, lambda: run_query(query, mimetype))
+    if len(body) > PROXY_MAX_RESULT_BYTES:
+        result_cache.invalidate(key)
+    return body
+
+
+def disk_cache_key(key):
+    """return the (class, URI) the disk cache stores example results under"""
+    query_hash, mimetype = key
+    return ('SPARQLExample/' + mimetype, 'sha1:' + query_hash)
+
+
+def load_example(key, query, mimetype):
+    """return the results of an example query, from the disk cache if possible"""
+    if model.disk_cache is not None:
+        cached = model.disk_cache.get(*disk_cache_key(key))
+        if cached is not None:
+            return cached[1]
+    return run_query(query, mimetype)
+
+
+class ExampleResults:
+    """computes the results of the example queries in a background thread
+
+    If the disk cache is shared, the results are computed by the process
+    holding its EXAMPLE_LOCK and stored there. The other processes load
+    them from there every retry_interval seconds, trying to take over the
+    lock each time in case the process holding it has exited."""
+
+    def __init__(self, root_path, interval=EXAMPLE_REFRESH_INTERVAL, retry_interval=EXAMPLE_RETRY_INTERVAL):
+        self.example_queries = model.ExampleQueries(root_path)
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.keys = frozenset() # cache keys of the example queries in their default format
+        self.refreshed = None # time of the last refresh
+        self.failed = 0 # queries that failed in the last refresh
+        self._started = False
+        self._lock = threading.Lock()
+        self._lock_file = None # holds EXAMPLE_LOCK of the disk cache
+
+    def queries(self):
+        """return [(query, mimetype)] for the example queries"""
+        queries = []
+        for title, query_id in self.example_queries.list_example_queries():
+            with open(os.path.join(self.example_queries.query_path, query_id + '.rq'), encoding='utf-8') as f:
+                query = f.read()
+            queries.append((query, result_formats(query)[0]))
+        return queries
+
+    def computes(self):
+        """return True if this process runs the example queries"""
+        disk_cache = model.disk_cache
+        if disk_cache is None:
+            return True
+        if self._lock_file is None:
+            self._lock_file = disk_cache.try_lock(EXAMPLE_LOCK)
+        return self._lock_file is not None
+
+    def refresh(self):
+        """compute (or load from the disk cache) the results of all example
+        queries; return the number of failures"""
+        queries = self.queries()
+        self.keys = frozenset(cache_key(query, mimetype) for query, mimetype in queries)
+        computes = self.computes()
+        failed = 0
+        for query, mimetype in queries:
+            key = cache_key(query, mimetype)
+            try:
+                if computes:
+                    body = run_query(query, mimetype)
+                    if model.disk_cache is not None:
+                        model.disk_cache.put(*disk_cache_key(key), body)
+                else:
+                    cached = model.disk_cache.get(*disk_cache_key(key))
+                    if cached is None:
+                        # not computed yet
+                        failed += 1
+                        continue
+                    body = cached[1]
+                example_cache.put(key, body)
+            except Exception:
+                # the previous results keep being served until they expire
+                failed += 1
+        self.refreshed = time.time()
+        self.failed = failed
+        return failed
+
+    def _run(self):
+        while True:
+            try:
+                failed = self.refresh()
+            except OSError:
+                failed = 1
+            if failed or not self.computes():
+                time.sleep(self.retry_interval)
+            else:
+                time.sleep(self.interval)
+
+    def start(self):
+        """start refreshing in the background, once"""
+        if self._started:
+            return
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._run, name='sparql-examples', daemon=True).start()
+
+
+examples = ExampleResults(app.root_path)
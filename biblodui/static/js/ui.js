@@ -14,22 +14,17 @@ $('#query').autocomplete({
     showNoSuggestionNotice: true,
     noSuggestionNotice: "No results",
     lookup: function (query, done) {
-        $.get('/bib/search.xml?query=' + query, function(data) {
-          var xml = $(data);
-          var items = [];
-          xml.find("item").each(function() {
-            var $this = $(this),
-              item = {
-                value: $this.find("category").text() + ": " + $this.find("title").text() + " (" + $this.find("link").text().split('/').pop() + ")",
-                data: {
-                  type: $this.find("category").text(),
-                  uri: $this.find("link").text()
-                }
+        $.getJSON('/bib/suggest', { query: query }, function(data) {
+          var items = $.map(data.suggestions, function(item) {
+            return {
+              value: item.type + ": " + item.name + " (" + item.url.split('/').pop() + ")",
+              data: {
+                type: item.type,
+                uri: item.url
               }
-            items.push(item);
+            };
           });
-          var result = { suggestions: items };
-          done(result);
+          done({ suggestions: items });
         });
     },
     onSearchStart: function (query) {
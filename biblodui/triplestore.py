@@ -0,0 +1,185 @@
+"""Compact read-only graphs for resource pages.
+
+An rdflib Graph with the default memory store keeps several dict based
+indexes per statement, which is a lot of memory and work for a graph that
+is only read after it has been loaded. A CompactGraph instead numbers the
+terms it contains and keeps the statements as sorted arrays of term
+numbers: one ordered by subject, predicate and object (SPO) and one by
+predicate, object and subject (POS). Lookups are binary searches.
+
+CompactGraph implements the parts of the rdflib Graph API that the model
+uses. Anything else, such as rdflib's serializers, can work on a copy made
+with to_graph().
+"""
+
+from array import array
+from bisect import bisect_left
+
+from rdflib import Graph, RDF, RDFS
+from rdflib.namespace import SKOS
+
+
+class GraphBuilder:
+    """collects statements (e.g. from a parser) for a CompactGraph"""
+
+    def __init__(self):
+        self.ids = {} # key: term, value: term number
+        self.terms = []
+        self.triples = set()
+
+    def _id(self, term):
+        termid = self.ids.get(term)
+        if termid is None:
+            termid = self.ids[term] = len(self.terms)
+            self.terms.append(term)
+        return termid
+
+    def add(self, triple):
+        s, p, o = triple
+        self.triples.add((self._id(s), self._id(p), self._id(o)))
+
+    def __len__(self):
+        return len(self.triples)
+
+    def build(self):
+        return CompactGraph(self.terms, self.ids, self.triples)
+
+
+class CompactGraph:
+    def __init__(self, terms, ids, triples):
+        self.terms = terms
+        self.ids = ids
+        # statements are numbered so that (s, p) and (p, o) pairs fit in one integer
+        n = self._n = max(len(terms), 1)
+        spo = sorted(triples)
+        self._sp = array('q', [s * n + p for s, p, o in spo])
+        self._spo_o = array('q', [o for s, p, o in spo])
+        pos = sorted((p, o, s) for s, p, o in triples)
+        self._po = array('q', [p * n + o for p, o, s in pos])
+        self._pos_s = array('q', [s for p, o, s in pos])
+
+    def __len__(self):
+        return len(self._sp)
+
+    def _range(self, keys, low, high):
+        """return the index range of keys (sorted) with low <= key < high"""
+        return (bisect_left(keys, low), bisect_left(keys, high))
+
+    def _sp_range(self, s, p=None):
+        n = self._n
+        if p is None:
+            return self._range(self._sp, s * n, (s + 1) * n)
+        return self._range(self._sp, s * n + p, s * n + p + 1)
+
+    def _po_range(self, p, o=None):
+        n = self._n
+        if o is None:
+            return self._range(self._po, p * n, (p + 1) * n)
+        return self._range(self._po, p * n + o, p * n + o + 1)
+
+    def __iter__(self):
+        terms = self.terms
+        n = self._n
+        for key, o in zip(self._sp, self._spo_o):
+            yield (terms[key // n], terms[key % n], terms[o])
+
+    def __contains__(self, triple):
+        s, p, o = (self.ids.get(term) for term in triple)
+        if s is None or p is None or o is None:
+            return False
+        start, end = self._sp_range(s, p)
+        return o in self._spo_o[start:end]
+
+    def triples(self, pattern):
+        s, p, o = pattern
+        ids = self.ids
+        terms = self.terms
+        n = self._n
+        if s is not None:
+            sid = ids.get(s)
+            pid = ids.get(p) if p is not None else None
+            if sid is None or (p is not None and pid is None):
+                return
+            start, end = self._sp_range(sid, pid)
+            for i in range(start, end):
+                obj = terms[self._spo_o[i]]
+                if o is None or obj == o:
+                    yield (s, terms[self._sp[i] % n], obj)
+        elif p is not None:
+            pid = ids.get(p)
+            oid = ids.get(o) if o is not None else None
+            if pid is None or (o is not None and oid is None):
+                return
+            start, end = self._po_range(pid, oid)
+            for i in range(start, end):
+                yield (terms[self._pos_s[i]], p, terms[self._po[i] % n])
+        else:
+            for triple in self:
+                if o is None or triple[2] == o:
+                    yield triple
+
+    def objects(self, subject=None, predicate=None):
+        if subject is not None:
+            sid = self.ids.get(subject)
+            pid = self.ids.get(predicate) if predicate is not None else None
+            if sid is None or (predicate is not None and pid is None):
+                return
+            terms = self.terms
+            start, end = self._sp_range(sid, pid)
+            for o in self._spo_o[start:end]:
+                yield terms[o]
+        else:
+            for s, p, o in self.triples((None, predicate, None)):
+                yield o
+
+    def subjects(self, predicate=None, object=None):
+        if predicate is None and object is None:
+            # each subject once, in SPO order
+            terms = self.terms
+            n = self._n
+            last = None
+            for key in self._sp:
+                s = key // n
+                if s != last:
+                    last = s
+                    yield terms[s]
+        else:
+            for s, p, o in self.triples((None, predicate, object)):
+                yield s
+
+    def predicates(self, subject=None, object=None):
+        for s, p, o in self.triples((subject, None, object)):
+            yield p
+
+    def predicate_objects(self, subject=None):
+        for s, p, o in self.triples((subject, None, None)):
+            yield (p, o)
+
+    def value(self, subject=None, predicate=RDF.value, object=None, default=None, any=True):
+        """return one object (or subject, if object is given) of the matching statements"""
+        if object is None:
+            values = self.objects(subject, predicate)
+        else:
+            values = self.subjects(predicate, object)
+        return next(values, default)
+
+    def preferredLabel(self, subject, lang=None, default=None,
+                       labelProperties=(SKOS.prefLabel, RDFS.label)):
+        """like rdflib's Graph.preferredLabel: return [(property, label)] for the
+        first of labelProperties with labels in the given language"""
+        for prop in labelProperties:
+            labels = [label for label in self.objects(subject, prop)
+                      if lang is None or getattr(label, 'language', None) == (lang or None)]
+            if labels:
+                return [(prop, label) for label in labels]
+        return default if default is not None else []
+
+    def to_graph(self):
+        """return a copy as an rdflib Graph"""
+        graph = Graph()
+        for triple in self:
+            graph.add(triple)
+        return graph
+
+    def serialize(self, *args, **kwargs):
+        return self.to_graph().serialize(*args, **kwargs)
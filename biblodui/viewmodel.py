@@ -0,0 +1,143 @@
+"""Immutable view models for rendering resource pages.
+
+A ResourceView is built once per request from the resource graph. The
+graph is scanned a single time; names, sort keys, property tables and the
+list of instances are then computed from that index, so templates don't
+need to go back to the graph (or recompute anything) while rendering.
+"""
+
+from collections import defaultdict, namedtuple
+from types import MappingProxyType
+
+from rdflib import URIRef, BNode, RDF
+
+from biblodui.model import SCHEMA, Instance, label_index, uri_to_url
+
+# properties not shown in property tables
+HIDDEN_PROPERTIES = (RDF.type, SCHEMA.workExample, SCHEMA.exampleOfWork)
+
+
+class Link(namedtuple('Link', ['name', 'url'])):
+    """a linked resource; url is None for blank nodes"""
+    __slots__ = ()
+
+    def __str__(self):
+        return self.name
+
+
+class PropertyTable(tuple):
+    """(property name, values) pairs ordered by property name"""
+
+    def items(self):
+        return iter(self)
+
+
+InstanceView = namedtuple('InstanceView', [
+    'uri', 'localname', 'typename', 'name', 'edition_info', 'finna_url', 'properties'])
+
+
+class ResourceView(namedtuple('ResourceView', [
+        'uri', 'url', 'localname', 'typename', 'name', 'is_agent',
+        'properties', 'instances', 'work_lists'])):
+    __slots__ = ()
+
+    def work_list_url(self, name):
+        return "%s/%s" % (self.url.rstrip('/'), name)
+
+
+def property_name(prop):
+    return prop.split('/')[-1].split('#')[-1] # local name
+
+
+class GraphIndex:
+    """outgoing edges of every subject, collected in one pass over a graph"""
+
+    def __init__(self, graph):
+        self.edges = defaultdict(lambda: defaultdict(list))
+        for s, p, o in graph:
+            self.edges[s][p].append(o)
+        self.labels = label_index(graph)
+
+    def objects(self, subject, prop):
+        if subject not in self.edges:
+            return []
+        return self.edges[subject].get(prop, [])
+
+    def value(self, subject, prop):
+        objs = self.objects(subject, prop)
+        return objs[0] if objs else None
+
+    def name(self, subject):
+        """same as Resource.name()"""
+        return self.labels.name(subject, "<%s>" % subject)
+
+    def properties(self, subject):
+        propvals = defaultdict(list) # key: property name, value: list of values
+        for prop, objs in self.edges.get(subject, {}).items():
+            if prop in HIDDEN_PROPERTIES:
+                continue
+            values = propvals[property_name(prop)]
+            for obj in objs:
+                if isinstance(obj, URIRef) or SCHEMA.name in self.edges.get(obj, ()):
+                    url = uri_to_url(obj) if isinstance(obj, URIRef) else None
+                    values.append(Link(str(self.name(obj)), url))
+                elif isinstance(obj, BNode):
+                    values.append(self.properties(obj))
+                else:
+                    values.append(obj)
+        return PropertyTable(
+            (propname, tuple(sorted(propvals[propname], key=lambda val: str(val).lower())))
+            for propname in sorted(propvals, key=str.lower))
+
+
+def edition_info(index, inst):
+    date_published = index.value(inst, SCHEMA.datePublished)
+    if date_published is None:
+        date_published = "-"
+    publisher_uri = index.value(inst, SCHEMA.publisher)
+    if publisher_uri is not None:
+        name = "%s : %s" % (date_published, index.name(publisher_uri))
+    else:
+        name = str(date_published)
+    if SCHEMA.EBook in index.objects(inst, SCHEMA.bookFormat):
+        name += ", e-book"
+    return name
+
+
+def finna_url(index, inst):
+    for ident in index.objects(inst, SCHEMA.identifier):
+        if str(index.value(ident, SCHEMA.propertyID)) == 'FI-FENNI':
+            finna_id = index.value(ident, SCHEMA.value)
+            if finna_id is not None:
+                return "https://finna.fi/Record/fennica.%s" % finna_id
+    return None
+
+
+def build_instance_view(index, inst, graph):
+    return InstanceView(uri=inst,
+                        localname=Instance(inst, graph).localname(),
+                        typename='Instance',
+                        name=str(index.name(inst)),
+                        edition_info=edition_info(index, inst),
+                        finna_url=finna_url(index, inst),
+                        properties=index.properties(inst))
+
+
+def build_view(res):
+    """return a ResourceView for the given model.Resource"""
+    index = GraphIndex(res.graph)
+    instances = []
+    if res.has_instances():
+        instances = [build_instance_view(index, inst, res.graph)
+                     for inst in index.objects(res.uri, SCHEMA.workExample)]
+        instances.sort(key=lambda inst: inst.edition_info.casefold())
+    work_lists = res.load_work_lists()
+    return ResourceView(uri=res.uri,
+                        url=res.url(),
+                        localname=res.localname(),
+                        typename=res.typename(),
+                        name=str(index.name(res.uri)),
+                        is_agent=res.is_agent(),
+                        properties=index.properties(res.uri),
+                        instances=tuple(instances),
+                        work_lists=MappingProxyType(work_lists))
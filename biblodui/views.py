@@ -1,9 +1,20 @@
-from flask import render_template, abort, redirect, request, make_response
+import hashlib
+import math
+import os
+import time
+
+from flask import render_template, abort, redirect, request, make_response, Response, jsonify, g
 from flask_rdf import wants_rdf
+from flask_rdf.format import decide
 from flask_rdf.flask import returns_rdf
+from werkzeug.http import http_date, is_resource_modified
 from werkzeug.routing import BaseConverter
 
-from biblodui import app, model
+from biblodui import app, model, export, metrics, profiling, admission, warmup, sparqlproxy
+from biblodui.cache import served_stale, reset_stale
+from biblodui.endpoint import EndpointError, EndpointUnavailable
+from biblodui.rendercache import RenderCache, InvalidationLog, ENCODINGS
+from biblodui.viewmodel import build_view
 
 
 class RegexConverter(BaseConverter):
@@ -13,36 +24,331 @@ class RegexConverter(BaseConverter):
 
 app.url_map.converters['regex'] = RegexConverter
 
+# Cache-Control header for resource pages and RDF downloads
+CACHE_CONTROL = 'public, max-age=3600'
+
+# rendered pages and RDF downloads, with precompressed variants
+RENDER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+RENDER_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024
+RENDER_CACHE_TTL = 3600 # seconds
+render_cache = RenderCache(RENDER_CACHE_MAX_BYTES, RENDER_CACHE_TTL, RENDER_CACHE_MAX_ENTRY_BYTES)
+
+# file of URI prefixes to invalidate, written by python -m biblodui.rendercache
+INVALIDATION_LOG = os.environ.get('BIBLODUI_INVALIDATION_LOG')
+invalidation_log = InvalidationLog(INVALIDATION_LOG) if INVALIDATION_LOG else None
+
+
+def templates_digest():
+    h = hashlib.sha1()
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    for fn in sorted(os.listdir(template_dir)):
+        with open(os.path.join(template_dir, fn), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+# changes when the templates change, so that HTML ETags change on deploy
+TEMPLATES_DIGEST = templates_digest()
+
+def resource_validators(res, variant):
+    """return (ETag, Last-Modified) for the given representation of a resource
+
+    HTML pages also change with the work lists and the templates, which the
+    fetch time of the graph doesn't cover, so they get no Last-Modified."""
+    h = hashlib.sha1(("%s %s" % (res.digest(), variant)).encode('utf-8'))
+    if variant == 'html':
+        h.update(TEMPLATES_DIGEST.encode('utf-8'))
+        for work_list in res.load_work_lists().values():
+            h.update(work_list.digest().encode('utf-8'))
+        return (h.hexdigest(), None)
+    fetched = res.fetched()
+    return (h.hexdigest(), http_date(fetched) if fetched is not None else None)
+
+def is_modified(etag, last_modified):
+    if request.if_none_match:
+        # a copy in any content coding is still valid; If-None-Match uses
+        # the weak comparison, e.g. proxies weaken the ETags of responses
+        # they compress
+        tags = [etag] + [tagged(etag, encoding) for encoding in ENCODINGS]
+        return not any(request.if_none_match.contains_weak(tag) for tag in tags)
+    return is_resource_modified(request.environ, last_modified=last_modified)
+
+def cache_headers(etag=None, last_modified=None):
+    headers = {'Cache-Control': CACHE_CONTROL}
+    if etag is not None:
+        headers['ETag'] = '"%s"' % etag
+    if last_modified is not None:
+        headers['Last-Modified'] = last_modified
+    return headers
+
+def store_rendered(chunks, key, etag, content_type):
+    """pass chunks through, then store the complete body in the render cache"""
+    buf = []
+    size = 0
+    for chunk in chunks:
+        if buf is not None:
+            buf.append(chunk)
+            size += len(chunk)
+            if size > render_cache.max_entry_bytes:
+                buf = None
+        yield chunk
+    if buf is not None:
+        render_cache.put(key, etag, b''.join(buf), content_type)
+
+def render_resource(res):
+    view = build_view(res)
+    return render_template('resource.html', title=view.name, view=view, res=res)
+
+def render_body(res, fmt):
+    """return the representation as bytes, or as a generator of chunks for streamed formats"""
+    if fmt in ('nt', 'turtle'):
+        return res.stream(fmt)
+    with metrics.RENDER_SECONDS.time(fmt):
+        if fmt == 'html':
+            return render_resource(res).encode('utf-8')
+        return res.serialize(fmt)
+
+def accepted_encoding(entry):
+    """return the preferred encoding of a render cache entry the client accepts, or None"""
+    return next((encoding for encoding in ENCODINGS
+                 if encoding in entry.bodies and request.accept_encodings[encoding]), None)
+
+def tagged(etag, encoding):
+    return etag if encoding is None else "%s-%s" % (etag, encoding)
+
+def make_cached_response(res, variant, fmt, content_type, vary=()):
+    """respond with the representation of res from the render cache, rendering it if needed"""
+    etag, last_modified = resource_validators(res, variant)
+    key = (str(res.uri), variant)
+    entry = render_cache.get(key, etag)
+    encoding = accepted_encoding(entry) if entry is not None else None
+    headers = cache_headers(tagged(etag, encoding), last_modified)
+    headers['Vary'] = ', '.join(vary + ('Accept-Encoding',))
+    if not is_modified(etag, last_modified):
+        return Response(status=304, headers=headers)
+
+    if entry is None:
+        body = render_body(res, fmt)
+        if not isinstance(body, bytes):
+            return Response(store_rendered(body, key, etag, content_type),
+                            content_type=content_type, headers=headers)
+        entry = render_cache.put(key, etag, body, content_type)
+        encoding = accepted_encoding(entry)
+        headers.update(cache_headers(tagged(etag, encoding)))
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return Response(entry.bodies[encoding or 'identity'], content_type=entry.content_type,
+                    headers=headers)
+
+# format suffix -> (rdflib format, Content-Type)
+FORMATS = {
+    'rdf': ('xml', 'application/rdf+xml'),
+    'ttl': ('turtle', 'text/turtle; charset=utf-8'),
+    'nt': ('nt', 'application/n-triples'),
+    'json': ('json-ld', 'application/json'),
+    'html': ('html', 'text/html; charset=utf-8'),
+}
 
 def make_format_response(res, fmt):
-    if not res.exists():
+    if fmt not in FORMATS:
         abort(404)
-    if fmt == 'rdf':
-        response = make_response(res.serialize('xml'))
-        response.headers['Content-Type'] = 'application/rdf+xml'
-    elif fmt == 'ttl':
-        response = make_response(res.serialize('turtle'))
-        response.headers['Content-Type'] = 'text/turtle'
-    elif fmt == 'nt':
-        response = make_response(res.serialize('nt'))
-        response.headers['Content-Type'] = 'application/n-triples'
-    elif fmt == 'json':
-        response = make_response(res.serialize('json-ld'))
-        response.headers['Content-Type'] = 'application/json'
-    elif fmt == 'html':
-        response = make_response(render_template('resource.html', title=res.name(), res=res))
-    else:
+    if fmt != 'html':
+        res = res.for_download()
+    if not res.exists():
         abort(404)
-    return response
+    return make_cached_response(res, fmt, *FORMATS[fmt])
 
 def make_resource_response(res):
+    accept = request.headers.get('Accept', '')
+    if wants_rdf(accept):
+        mimetype, fmt = decide(accept)
+        if mimetype is None:
+            abort(406)
+        content_type = mimetype
+        if mimetype.startswith('text/'):
+            content_type += '; charset=utf-8'
+        res = res.for_download()
+    else:
+        mimetype, fmt, content_type = 'html', 'html', FORMATS['html'][1]
+    # checked on the graph variant that is served
     if not res.exists():
         abort(404)
-    if wants_rdf(request.headers.get('Accept', '')):
-        data = res.graph
+    return make_cached_response(res, mimetype, fmt, content_type, vary=('Accept',))
+
+def invalidate(uri_prefix=''):
+    """drop cached graphs, work lists and rendered pages for URIs starting with uri_prefix"""
+    model.invalidate(uri_prefix)
+    render_cache.invalidate(uri_prefix)
+
+@app.before_request
+def start_profile():
+    fmt = profiling.requested_format(request.args, request.headers)
+    if fmt is not None:
+        g.profile = profiling.RequestProfile(fmt)
+        g.profile.start()
     else:
-        data = render_template('resource.html', title=res.name(), res=res)
-    return (data, 200, {'Vary': 'Accept'})
+        g.profile_sample = profiling.sample_request()
+
+@app.after_request
+def finish_profile(response):
+    # registered first, so this runs after the other after_request hooks
+    profile = g.pop('profile', None)
+    if profile is not None:
+        if response.is_streamed:
+            # produce the body while the profile is running
+            response.get_data()
+        response.headers['X-Profile'] = profile.stop()
+        response.headers['Cache-Control'] = 'no-store'
+    sample = g.pop('profile_sample', None)
+    if sample is not None:
+        response.call_on_close(lambda: profiling.end_sample(sample))
+    return response
+
+@app.teardown_request
+def discard_profile(exc):
+    # only left over if the response was never finished
+    if g.get('profile') is not None:
+        g.pop('profile').stop()
+    if g.get('profile_sample') is not None:
+        profiling.end_sample(g.pop('profile_sample'))
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        fmt = response.mimetype or ''
+        metrics.REQUESTS.inc(route, fmt, str(response.status_code))
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, route, fmt)
+        if not response.is_streamed and response.content_length is not None:
+            metrics.RESPONSE_BYTES.observe(response.content_length, route, fmt)
+    return response
+
+@metrics.collector
+def cache_metrics():
+    caches = [('graph', model.graph_cache.stats()),
+              ('work_list', model.list_cache.stats()),
+              ('search', model.search_cache.stats()),
+              ('suggest', model.suggest_cache.stats()),
+              ('sparql', sparqlproxy.result_cache.stats()),
+              ('sparql_examples', sparqlproxy.example_cache.stats()),
+              ('render', render_cache.stats())]
+    hits = []
+    misses = []
+    ratios = []
+    for name, stats in caches:
+        # coalesced lookups waited for another request's load instead of loading
+        cache_hits = stats['hits'] + stats.get('coalesced', 0)
+        lookups = cache_hits + stats['misses']
+        hits.append(({'cache': name}, cache_hits))
+        misses.append(({'cache': name}, stats['misses']))
+        ratios.append(({'cache': name}, cache_hits / lookups if lookups else 0.0))
+    return [('biblodui_cache_hits_total', 'counter', 'Cache lookups answered from the cache', hits),
+            ('biblodui_cache_misses_total', 'counter', 'Cache lookups that had to load the value', misses),
+            ('biblodui_cache_hit_ratio', 'gauge', 'Share of cache lookups that were hits', ratios),
+            ('biblodui_cache_stale_total', 'counter', 'Expired values served because reloading failed',
+             [({'cache': name}, stats['stale']) for name, stats in caches if 'stale' in stats]),
+            ('biblodui_endpoint_circuit_open', 'gauge', 'Whether queries to the SPARQL endpoint are refused',
+             [({}, 0 if model.breaker.state() == 'closed' else 1)])]
+
+@metrics.collector
+def admission_metrics():
+    limiters = sorted(admission.limiters.items())
+    rate_limiters = [(group, limiter) for group, limiter in sorted(admission.rate_limiters.items())
+                     if limiter is not None]
+    return [('biblodui_admission_active', 'gauge', 'SPARQL queries running, by budget',
+             [({'budget': name}, limiter.active) for name, limiter in limiters]),
+            ('biblodui_admission_queued', 'gauge', 'SPARQL queries waiting for admission, by budget',
+             [({'budget': name}, limiter.waiting) for name, limiter in limiters]),
+            ('biblodui_admission_admitted_total', 'counter', 'SPARQL queries admitted, by budget',
+             [({'budget': name}, limiter.admitted) for name, limiter in limiters]),
+            ('biblodui_admission_rejected_total', 'counter', 'SPARQL queries rejected as overload, by budget',
+             [({'budget': name}, limiter.rejected) for name, limiter in limiters]),
+            ('biblodui_rate_limited_total', 'counter', 'Requests rejected by per-client rate limits',
+             [({'group': group}, limiter.rejected) for group, limiter in rate_limiters])]
+
+# responses built from stale data may only be cached briefly
+STALE_CACHE_CONTROL = 'public, max-age=60'
+
+@app.before_request
+def start_stale_check():
+    reset_stale()
+
+@app.after_request
+def flag_stale(response):
+    if served_stale():
+        response.headers['Warning'] = '110 - "Response is Stale"'
+        response.headers['Cache-Control'] = STALE_CACHE_CONTROL
+        metrics.STALE_RESPONSES.inc()
+    return response
+
+@app.errorhandler(EndpointUnavailable)
+def endpoint_unavailable(e):
+    retry_after = getattr(e, 'retry_after', None) or max(math.ceil(model.breaker.retry_after()), 1)
+    return Response("The SPARQL endpoint is not available at the moment. Please try again later.\n",
+                    status=503, content_type='text/plain; charset=utf-8',
+                    headers={'Retry-After': str(retry_after)})
+
+def rate_limit_group():
+    """return the rate limit group of the request ('search', 'download' or 'sparql'), or None"""
+    endpoint = request.endpoint or ''
+    if endpoint in ('search', 'suggest'):
+        return 'search'
+    if endpoint == 'bulk_export':
+        return 'download'
+    if endpoint == 'sparql' and (request.method == 'POST' or 'query' in request.args):
+        return 'sparql'
+    if endpoint.endswith('_format') and (request.view_args or {}).get('fmt') != 'html':
+        return 'download'
+    return None
+
+@app.before_request
+def limit_rate():
+    limiter = admission.rate_limiters.get(rate_limit_group())
+    if limiter is not None:
+        wait = limiter.allow(request.remote_addr)
+        if wait:
+            return Response("Too many requests, please slow down.\n", status=429,
+                            content_type='text/plain; charset=utf-8',
+                            headers={'Retry-After': str(math.ceil(wait))})
+
+@app.before_request
+def apply_invalidations():
+    if invalidation_log is not None:
+        for uri_prefix in invalidation_log.poll():
+            invalidate(uri_prefix)
+
+WORK_LIST_HEADINGS = {
+    'authored': 'Authored works',
+    'contributed': 'Works contributed to',
+    'about': 'Works about',
+}
+
+def make_work_list_response(res, listname):
+    if listname not in res.work_lists or not res.exists():
+        abort(404)
+    page = request.args.get('page', default=1, type=int)
+    if page < 1:
+        abort(404)
+    works = res.work_list(listname, page)
+    if page > works.pages():
+        abort(404)
+    title = "%s: %s" % (res.name(), WORK_LIST_HEADINGS[listname])
+    return render_template('worklist.html', title=title, res=res, works=works,
+                           heading=WORK_LIST_HEADINGS[listname])
+
+@app.before_request
+def refresh_index_lists():
+    # load the index page lists in the background on the first request of
+    # the process, and reload them whenever due
+    model.collections_data.refresh()
+    model.conceptschemes_data.refresh()
+    # warm the caches from BIBLODUI_WARMUP, if set
+    warmup.start_background()
+    sparqlproxy.examples.start()
 
 @app.route('/')
 @app.route('/index')
@@ -63,14 +369,19 @@ def bib_resource_format(resourceid, fmt):
     res = model.get_resource('http://urn.fi/URN:NBN:fi:bib:me:%s' % resourceid)
     return make_format_response(res, fmt)
 
+@app.route('/bib/me/<string(length=12):resourceid>/<listname>')
+def bib_resource_work_list(resourceid, listname):
+    res = model.get_resource('http://urn.fi/URN:NBN:fi:bib:me:%s' % resourceid)
+    return make_work_list_response(res, listname)
+
 @app.route('/bib/me/I<instanceid>')
 @returns_rdf
 def bib_instance(instanceid):
     inst = model.get_resource('http://urn.fi/URN:NBN:fi:bib:me:I%s' % instanceid)
-    if not inst.exists():
+    work_uri = inst.work_uri()
+    if work_uri is None:
         abort(404)
-    work = inst.get_work()
-    return redirect("%s#I%s" % (work.url(), instanceid))
+    return redirect("%s#I%s" % (model.uri_to_url(work_uri), instanceid))
 
 @app.route('/bib/me/C<collectionid>')
 @returns_rdf
@@ -89,6 +400,11 @@ def person_resource_format(personid, fmt):
     res = model.get_resource('http://urn.fi/URN:NBN:fi:au:pn:%s' % personid)
     return make_format_response(res, fmt)
 
+@app.route('/au/pn/<regex("[0-9]+"):personid>/<listname>')
+def person_resource_work_list(personid, listname):
+    res = model.get_resource('http://urn.fi/URN:NBN:fi:au:pn:%s' % personid)
+    return make_work_list_response(res, listname)
+
 @app.route('/au/cn/')
 def organization():
     res = model.get_resource('http://urn.fi/URN:NBN:fi:au:cn:')
@@ -105,6 +421,11 @@ def organization_resource_format(organizationid, fmt):
     res = model.get_resource('http://urn.fi/URN:NBN:fi:au:cn:%s' % organizationid)
     return make_format_response(res, fmt)
 
+@app.route('/au/cn/<regex("[0-9]+A"):organizationid>/<listname>')
+def organization_resource_work_list(organizationid, listname):
+    res = model.get_resource('http://urn.fi/URN:NBN:fi:au:cn:%s' % organizationid)
+    return make_work_list_response(res, listname)
+
 @app.route('/yso/')
 def yso():
     res = model.get_resource('http://www.yso.fi/onto/yso/')
@@ -136,26 +457,107 @@ def concept_resource_format(conceptid, fmt):
     res = model.get_resource('http://www.yso.fi/onto/yso/%s' % conceptid)
     return make_format_response(res, fmt)
 
+@app.route('/yso/<regex("p[0-9]+"):conceptid>/<listname>')
+def concept_resource_work_list(conceptid, listname):
+    res = model.get_resource('http://www.yso.fi/onto/yso/%s' % conceptid)
+    return make_work_list_response(res, listname)
+
 @app.route('/bib/search.<fmt>')
 def search(fmt):
     if fmt not in ('html','xml'):
         abort(404)
     query = request.args.get('query')
-    items_per_page = request.args.get('count', default=20, type=int)
-    search = model.Search(query, items_per_page)
+    items_per_page = max(request.args.get('count', default=20, type=int), 1)
+    start_index = max(request.args.get('startIndex', default=1, type=int), 1)
+    start_page = max(request.args.get('startPage', default=1, type=int), 1)
+    search = model.Search(query, items_per_page, start_index, start_page)
     response = make_response(render_template('search.%s' % fmt, search=search, base_url=request.base_url, url_root=request.url_root))
     if fmt == 'xml':
         response.headers['Content-Type'] = 'application/rss+xml; charset=utf-8'
     return response
 
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+@app.route('/bib/suggest')
+def suggest():
+    query = request.args.get('query', '')
+    limit = min(request.args.get('limit', default=SUGGEST_LIMIT, type=int), SUGGEST_MAX_LIMIT)
+    suggestions = model.Suggestions(query, max(limit, 0))
+    response = jsonify(query=suggestions.query_string,
+                       suggestions=[{'name': result.name(),
+                                     'type': result.typename(),
+                                     'url': result.uri()}
+                                    for result in suggestions.results()])
+    response.headers['Cache-Control'] = 'public, max-age=%d' % model.SUGGEST_CACHE_TTL
+    return response
+
+# format suffix -> (export format, Content-Type)
+EXPORT_FORMATS = {
+    'nt': ('nt', 'application/n-triples'),
+    'nq': ('nquads', 'application/n-quads'),
+}
+
+@app.route('/bib/export', methods=['POST'])
+@app.route('/bib/export.<fmt>', methods=['POST'])
+def bulk_export(fmt='nt'):
+    """export the graphs of the resources listed in the request body, one ID,
+    URL path or URI per line, or as a JSON array"""
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    if request.is_json:
+        ids = request.get_json()
+        if not isinstance(ids, list):
+            abort(400)
+    else:
+        ids = (line.decode('utf-8') for line in request.stream)
+    uris = []
+    for ident in ids:
+        if str(ident).strip():
+            uris.append(export.resolve_id(str(ident)))
+            if len(uris) > export.EXPORT_MAX_RESOURCES:
+                abort(413)
+    export_format, content_type = EXPORT_FORMATS[fmt]
+    return Response(export.iter_export(uris, export_format), content_type=content_type)
+
 @app.route('/bib/opensearchdescription.xml')
 def opensearchdescription():
     response = make_response(render_template('opensearchdescription.xml', url_root=request.url_root))
     response.headers['Content-Type'] = 'application/opensearchdescription+xml; charset=utf-8'
     return response
 
-@app.route('/bib/sparql')
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def sparql_query():
+    """return the query of a SPARQL protocol request, or None"""
+    if request.method == 'POST' and request.mimetype == 'application/sparql-query':
+        return request.get_data(as_text=True)
+    return request.values.get('query')
+
+@app.route('/bib/sparql', methods=['GET', 'POST'])
 def sparql():
-    example_queries = model.ExampleQueries(app.root_path)
-    return render_template('sparql.html', title='SPARQL query form', example_queries=example_queries)
+    query = sparql_query()
+    if query is None:
+        example_queries = model.ExampleQueries(app.root_path)
+        return render_template('sparql.html', title='SPARQL query form', example_queries=example_queries)
+    if 'default-graph-uri' in request.values or 'named-graph-uri' in request.values:
+        return Response("Dataset parameters are not supported.\n", status=400,
+                        content_type='text/plain; charset=utf-8')
+    formats = sparqlproxy.result_formats(query)
+    mimetype = request.accept_mimetypes.best_match(formats, default=formats[0])
+    try:
+        body = sparqlproxy.get_results(query, mimetype)
+    except EndpointError as e:
+        # e.g. a syntax error in the query
+        status = e.status if e.status < 500 else 502
+        return Response(e.body, status=status, content_type='text/plain; charset=utf-8')
+    headers = {'Vary': 'Accept'}
+    if request.method == 'GET':
+        headers['Cache-Control'] = 'public, max-age=%d' % sparqlproxy.PROXY_CACHE_TTL
+    content_type = mimetype
+    if mimetype.startswith('text/'):
+        content_type += '; charset=utf-8'
+    return Response(body, content_type=content_type, headers=headers)
 
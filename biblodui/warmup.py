@@ -0,0 +1,214 @@
+"""Warm up the caches with the most requested resources.
+
+The resource paths in access logs (common or combined log format, possibly
+gzipped) or in plain lists of paths or URIs are ranked by the number of
+successful requests, and the graphs and HTML pages of the top resources
+are loaded with bounded concurrency and rate, so that warming doesn't
+overload the endpoint.
+
+    python -m biblodui.warmup /var/log/nginx/access.log.1 --top 2000
+
+warms the disk cache (BIBLODUI_DISK_CACHE) shared by the worker processes,
+and with --url http://localhost:5000 a running server instead. With
+BIBLODUI_WARMUP set to such a file, the caches are also warmed in the
+background after the first request, once per host: only the worker
+process that takes the warm-up lock does it, warming the disk cache shared
+with the others (and its own memory caches).
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from biblodui import app, model
+from biblodui.diskcache import try_lock
+
+WARMUP_SOURCE = os.environ.get('BIBLODUI_WARMUP') # access log or URI list warmed on startup
+WARMUP_TOP = 1000 # number of resources warmed
+WARMUP_CONCURRENCY = 2 # resources loaded at the same time
+WARMUP_RATE = 5 # resources started per second
+WARMUP_HTTP_TIMEOUT = 60 # seconds, with --url
+WARMUP_LOCK = 'warmup' # name of the lock taken by the warming process
+
+# the request and status of a common/combined log format line
+LOG_LINE = re.compile(r'"(?:GET|HEAD) (\S+) HTTP/[0-9.]+" (\d{3}) ')
+FORMAT_SUFFIX = re.compile(r'\.(html|ttl|nt|rdf|json)$')
+
+
+def read_lines(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
+
+
+def resource_uri(path):
+    """return the URI of the resource a request path (or URI) is about, or None"""
+    if not path.startswith('/'):
+        uri = path
+    else:
+        path = path.split('?', 1)[0]
+        path = FORMAT_SUFFIX.sub('', path)
+        head, _, tail = path.rpartition('/')
+        if tail in model.WORK_LISTS:
+            path = head
+        elif tail == 'index':
+            path = head + '/'
+        uri = model.url_to_uri(path)
+        if uri == path:
+            return None
+    if type(model.get_resource(uri)) is model.Resource:
+        return None
+    return uri
+
+
+def rank(lines):
+    """return Counter of resource URIs requested in lines"""
+    counts = Counter()
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = LOG_LINE.search(line)
+        if match is not None:
+            if match.group(2) not in ('200', '304'):
+                continue
+            path = match.group(1)
+        else:
+            path = line.split()[0]
+        uri = resource_uri(path)
+        if uri is not None:
+            counts[uri] += 1
+    return counts
+
+
+def top_uris(sources, top=WARMUP_TOP):
+    counts = Counter()
+    for source in sources:
+        lines = read_lines(source)
+        try:
+            counts.update(rank(lines))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+    return [uri for uri, count in counts.most_common(top)]
+
+
+def warm_resource(uri):
+    """load the graph and the HTML page of a resource into the caches of this process"""
+    # imported here, views imports this module
+    from biblodui import views
+    res = model.get_resource(uri)
+    if isinstance(res, model.Instance):
+        # instance pages only redirect to the work
+        res.work_uri()
+        return
+    with app.test_request_context(model.uri_to_url(uri)):
+        views.make_resource_response(res)
+
+
+def fetch_page(base_url, uri):
+    """request the HTML page of a resource from a running server"""
+    url = base_url.rstrip('/') + model.uri_to_url(uri)
+    with urllib.request.urlopen(url, timeout=WARMUP_HTTP_TIMEOUT) as response:
+        response.read()
+
+
+def warm(uris, load=warm_resource, concurrency=WARMUP_CONCURRENCY, rate=WARMUP_RATE, log=None):
+    """call load(uri) for each URI, at most concurrency at a time and rate per second;
+    return the number of failures"""
+    failures = []
+    slots = threading.BoundedSemaphore(concurrency)
+
+    def run(uri):
+        try:
+            load(uri)
+        except Exception as e:
+            failures.append(uri)
+            if log is not None:
+                print("%s: %s" % (uri, e), file=log)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix='warmup') as pool:
+        next_start = time.monotonic()
+        for uri in uris:
+            wait = next_start - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_start = max(next_start, time.monotonic()) + 1.0 / rate
+            slots.acquire()
+            pool.submit(run, uri)
+    return len(failures)
+
+
+def take_lock():
+    """return an open file holding the warm-up lock of the host, or None if
+    another process holds it
+
+    The lock is next to the disk cache if there is one, otherwise in the
+    temporary directory."""
+    if model.disk_cache is not None:
+        return model.disk_cache.try_lock(WARMUP_LOCK)
+    return try_lock(os.path.join(tempfile.gettempdir(), 'biblodui-%s.lock' % WARMUP_LOCK))
+
+
+_started = False
+_start_lock = threading.Lock()
+_lock_file = None # held while this process lives, so that no other one warms
+
+
+def start_background():
+    """warm the caches from WARMUP_SOURCE in a background thread, if this
+    process is the first on the host to try"""
+    global _started, _lock_file
+    if not WARMUP_SOURCE or _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    _lock_file = take_lock()
+    if _lock_file is None:
+        return
+    thread = threading.Thread(target=lambda: warm(top_uris([WARMUP_SOURCE])),
+                              name='warmup', daemon=True)
+    thread.start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warm up the caches with the most requested resources')
+    parser.add_argument('sources', nargs='+', help="access logs or lists of paths or URIs ('-' for stdin)")
+    parser.add_argument('--top', type=int, default=WARMUP_TOP, help='number of resources (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=WARMUP_CONCURRENCY)
+    parser.add_argument('--rate', type=float, default=WARMUP_RATE, help='resources per second (default: %(default)s)')
+    parser.add_argument('--url', help='warm a running server at this URL instead of the disk cache')
+    parser.add_argument('--dry-run', action='store_true', help='only list the resources with their rank')
+    args = parser.parse_args(argv)
+
+    uris = top_uris(args.sources, args.top)
+    if args.dry_run:
+        for uri in uris:
+            print(uri)
+        return
+    if args.url:
+        load = lambda uri: fetch_page(args.url, uri)
+    elif model.disk_cache is None:
+        parser.error("set BIBLODUI_DISK_CACHE or --url, warming this process alone has no effect")
+    else:
+        load = warm_resource
+    start = time.monotonic()
+    failed = warm(uris, load, args.concurrency, args.rate, log=sys.stderr)
+    print("warmed %d resources in %.1f s, %d failed" % (len(uris) - failed, time.monotonic() - start, failed))
+
+if __name__ == '__main__':
+    main()
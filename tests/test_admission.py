@@ -0,0 +1,70 @@
+import threading
+import unittest
+
+from biblodui import model
+from biblodui.admission import ADMISSION_LIMITS, ConcurrencyLimiter, Overloaded, limiter
+
+# cold resource graphs of one class fetched at the same time by a worker process
+CONCURRENT_GRAPH_FETCHES = 3
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    def test_slots_are_taken_together(self):
+        limiter = ConcurrencyLimiter('Work', 5, 1, queue_timeout=0.01)
+        self.assertEqual(limiter.acquire(5), 5)
+        with self.assertRaises(Overloaded):
+            limiter.acquire()
+        limiter.release(5)
+        self.assertEqual(limiter.active, 0)
+
+    def test_at_most_limit_slots(self):
+        limiter = ConcurrencyLimiter('Agent', 2, 1)
+        with limiter.slot(5):
+            self.assertEqual(limiter.active, 2)
+        self.assertEqual(limiter.active, 0)
+
+    def test_waits_for_enough_free_slots(self):
+        limiter = ConcurrencyLimiter('Work', 5, 1, queue_timeout=5)
+        limiter.acquire(3)
+        admitted = threading.Event()
+
+        def wait():
+            with limiter.slot(3):
+                admitted.set()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        self.assertFalse(admitted.wait(0.05))
+        limiter.release(3)
+        self.assertTrue(admitted.wait(5))
+        thread.join(5)
+        self.assertEqual((limiter.active, limiter.admitted, limiter.rejected), (0, 2, 0))
+
+    def test_full_queue_is_rejected(self):
+        limiter = ConcurrencyLimiter('Search', 1, 0)
+        with limiter.slot():
+            with self.assertRaises(Overloaded):
+                limiter.acquire()
+        self.assertEqual(limiter.rejected, 1)
+
+
+class BudgetTest(unittest.TestCase):
+    def test_expensive_budgets_leave_free_connections(self):
+        expensive = sum(limit for name, (limit, queue_size) in ADMISSION_LIMITS.items() if name != 'Resource')
+        self.assertLess(expensive, model.ENDPOINT_POOL_SIZE)
+
+    def test_graph_fetches_run_concurrently(self):
+        for cls in (model.Resource, model.Work, model.Collection, model.Agent, model.Person,
+                    model.Organization, model.Concept):
+            res = cls('http://example.org/resource')
+            for variant in (res, res.for_download()):
+                budget = limiter(cls.__name__)
+                # a fresh limiter with the same limit, without a queue
+                fetches = ConcurrencyLimiter(budget.name, budget.limit, 0)
+                for i in range(CONCURRENT_GRAPH_FETCHES):
+                    self.assertEqual(fetches.acquire(len(variant.fetch_queries())),
+                                     len(variant.fetch_queries()), cls.__name__)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from biblodui.cache import GraphCache, served_stale, reset_stale
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class GraphCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('biblodui.cache.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_stale()
+
+    def test_hit_after_load(self):
+        cache = GraphCache(10, 60)
+        self.assertEqual(cache.get('a', lambda: 1), 1)
+        self.assertEqual(cache.get('a', lambda: 2), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_single_flight(self):
+        cache = GraphCache(10, 60)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return 'value'
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(cache.get('k', loader)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(cache.get('k', loader)))
+                     for i in range(5)]
+        for thread in followers:
+            thread.start()
+        # wait until all followers are waiting on the flight
+        for i in range(500):
+            if cache.coalesced == 5:
+                break
+            time.sleep(0.01)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['value'] * 6)
+        self.assertEqual((cache.misses, cache.coalesced), (1, 5))
+
+    def test_loader_error_is_shared_and_not_cached(self):
+        cache = GraphCache(10, 60)
+        started = threading.Event()
+        release = threading.Event()
+
+        def failing():
+            started.set()
+            release.wait(5)
+            raise KeyError('boom')
+
+        errors = []
+
+        def get():
+            try:
+                cache.get('k', failing)
+            except KeyError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=get)
+        follower.start()
+        for i in range(500):
+            if cache.coalesced == 1:
+                break
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(cache.get('k', lambda: 'loaded'), 'loaded')
+
+    def test_expiry(self):
+        cache = GraphCache(10, 60)
+        cache.get('a', lambda: 1)
+        self.clock.now += 59
+        self.assertEqual(cache.get('a', lambda: 2), 1)
+        self.clock.now += 2
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.get('a', lambda: 2), 2)
+
+    def test_lru_eviction(self):
+        cache = GraphCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a', lambda: None) # a is now the most recently used
+        cache.put('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_stale_value_served_on_error(self):
+        cache = GraphCache(10, 60, stale_ttl=100, stale_errors=(OSError,))
+        cache.get('a', lambda: 'old')
+        self.clock.now += 120
+
+        def failing():
+            raise OSError('endpoint down')
+
+        self.assertEqual(cache.get('a', failing), 'old')
+        self.assertTrue(served_stale())
+        self.assertEqual(cache.stale, 1)
+        # the stale value is not refreshed, the next lookup tries to load again
+        reset_stale()
+        self.assertEqual(cache.get('a', lambda: 'new'), 'new')
+        self.assertFalse(served_stale())
+
+    def test_stale_value_not_served_for_other_errors(self):
+        cache = GraphCache(10, 60, stale_ttl=100, stale_errors=(OSError,))
+        cache.get('a', lambda: 'old')
+        self.clock.now += 120
+
+        def failing():
+            raise ValueError('bad data')
+
+        with self.assertRaises(ValueError):
+            cache.get('a', failing)
+
+    def test_stale_value_expires(self):
+        cache = GraphCache(10, 60, stale_ttl=100, stale_errors=(OSError,))
+        cache.get('a', lambda: 'old')
+        self.clock.now += 161
+
+        def failing():
+            raise OSError('endpoint down')
+
+        with self.assertRaises(OSError):
+            cache.get('a', failing)
+        self.assertFalse(served_stale())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from biblodui.diskcache import DiskGraphCache
+
+
+class DiskGraphCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'graphs.db')
+
+    def summed_size(self, cache):
+        return cache._connect().execute('SELECT COALESCE(SUM(size), 0) FROM graph').fetchone()[0]
+
+    def test_total_size_follows_writes(self):
+        cache = DiskGraphCache(self.path)
+        cache.put('Work', 'http://example.org/a', b'<a> <p> "x" .\n' * 100)
+        cache.put('Work', 'http://example.org/b', b'<b> <p> "y" .\n')
+        # replacing an entry
+        cache.put('Work', 'http://example.org/a', b'<a> <p> "z" .\n')
+        self.assertEqual(cache.total_size(), self.summed_size(cache))
+        cache.purge('http://example.org/b')
+        self.assertEqual(cache.total_size(), self.summed_size(cache))
+        # shared with other processes opening the same database
+        self.assertEqual(DiskGraphCache(self.path).total_size(), cache.total_size())
+
+    def test_evicts_least_recently_used(self):
+        data = os.urandom(1000)
+        cache = DiskGraphCache(self.path, max_bytes=2500)
+        for name in 'abc':
+            cache.put('Work', 'http://example.org/' + name, data)
+        self.assertIsNone(cache.get('Work', 'http://example.org/a'))
+        self.assertIsNotNone(cache.get('Work', 'http://example.org/c'))
+        self.assertLessEqual(cache.total_size(), 2500)
+        self.assertEqual(cache.total_size(), self.summed_size(cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+from unittest import mock
+
+from biblodui.endpoint import CircuitBreaker, QueryTimeout, SPARQLClient
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('biblodui.endpoint.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+
+    def fail(self, times):
+        for i in range(times):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state(), 'closed')
+        self.fail(1)
+        self.assertEqual(self.breaker.state(), 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 30)
+
+    def test_success_resets_failure_count(self):
+        self.fail(2)
+        self.breaker.success()
+        self.fail(2)
+        self.assertEqual(self.breaker.state(), 'closed')
+
+    def test_single_probe_after_reset_timeout(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertEqual(self.breaker.state(), 'half-open')
+        self.assertTrue(self.breaker.allow())
+        # only one probe at a time
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+        self.assertEqual(self.breaker.state(), 'closed')
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_after(), 0)
+
+    def test_failed_probe_reopens(self):
+        self.fail(3)
+        self.clock.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state(), 'open')
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+
+
+class SPARQLClientTest(unittest.TestCase):
+    def test_no_free_connection_is_not_an_endpoint_failure(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = SPARQLClient('http://127.0.0.1:9/sparql', pool_size=1, breaker=breaker)
+        client.pool.reserve()
+        with self.assertRaisesRegex(QueryTimeout, 'no free connection'):
+            client.query('ASK {}', 'application/sparql-results+json', timeout=0.01)
+        self.assertEqual(breaker.state(), 'closed')
+
+    def test_refused_query_releases_its_connection_slot(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.allow()
+        breaker.failure()
+        client = SPARQLClient('http://127.0.0.1:9/sparql', pool_size=1, breaker=breaker)
+        for i in range(2):
+            with self.assertRaisesRegex(Exception, 'circuit is open'):
+                client.query('ASK {}', 'application/sparql-results+json', timeout=0.01)
+        client.pool.reserve(0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import time
+import unittest
+from unittest import mock
+
+from biblodui import model
+from biblodui.cache import served_stale, reset_stale
+from biblodui.endpoint import EndpointError
+
+EX = 'http://example.org/'
+
+
+def binding(uri, literal, score, type='http://schema.org/Person'):
+    return {'uri': {'type': 'uri', 'value': EX + uri},
+            'score': {'type': 'literal', 'value': str(score)},
+            'literal': {'type': 'literal', 'value': literal},
+            'type': {'type': 'uri', 'value': type}}
+
+
+class SuggestionsTest(unittest.TestCase):
+    def setUp(self):
+        model.suggest_cache.invalidate()
+        self.addCleanup(model.suggest_cache.invalidate)
+        self.sparql = mock.Mock()
+        self.sparql.select.return_value = {'results': {'bindings': [
+            binding('kivi', 'Kivi, Aleksis', 3.0),
+            binding('kivi', 'Kivimies, Aleksis', 2.0),
+            binding('stone', 'Kivinen, Kari', 1.0),
+        ]}}
+        patcher = mock.patch.object(model, 'sparql', self.sparql)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def uris(self, suggestions):
+        return [b['uri']['value'] for b in suggestions.bindings]
+
+    def test_each_resource_suggested_once(self):
+        suggestions = model.Suggestions('kivi')
+        self.assertEqual(self.uris(suggestions), [EX + 'kivi', EX + 'stone'])
+        self.assertEqual(suggestions.bindings[0]['literal']['value'], 'Kivi, Aleksis')
+
+    def test_longer_prefix_filters_cached_matches(self):
+        model.Suggestions('kivi')
+        suggestions = model.Suggestions('kivim')
+        # matched by its second label, without querying the endpoint again
+        self.assertEqual(self.uris(suggestions), [EX + 'kivi'])
+        self.assertEqual(suggestions.bindings[0]['literal']['value'], 'Kivimies, Aleksis')
+        self.assertEqual(self.sparql.select.call_count, 1)
+
+
+class WorkListTest(unittest.TestCase):
+    def setUp(self):
+        model.list_cache.invalidate()
+        self.addCleanup(model.list_cache.invalidate)
+        self.sparql = mock.Mock()
+        patcher = mock.patch.object(model, 'sparql', self.sparql)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_count_and_page_from_one_query(self):
+        self.sparql.select.return_value = {'results': {'bindings': [
+            {'work': {'type': 'uri', 'value': EX + 'w2'}, 'name': {'type': 'literal', 'value': 'beta'}},
+            {'count': {'type': 'literal', 'value': '102'}},
+            {'work': {'type': 'uri', 'value': EX + 'w1'}, 'name': {'type': 'literal', 'value': 'Alpha'}},
+        ]}}
+        works = model.WorkList(EX + 'author', model.SCHEMA.author, page=2, page_size=50)
+        self.assertEqual(works.total, 102)
+        self.assertEqual(works.pages(), 3)
+        self.assertEqual([b['work']['value'] for b in works.bindings], [EX + 'w1', EX + 'w2'])
+        self.assertEqual(self.sparql.select.call_count, 1)
+        self.assertIn('OFFSET 50', self.sparql.select.call_args[0][0])
+
+    def test_stale_first_pages_flag_the_request(self):
+        self.sparql.timeout = 20
+        self.sparql.select.return_value = {'results': {'bindings': [
+            {'count': {'type': 'literal', 'value': '0'}},
+        ]}}
+        person = model.Person(EX + 'author')
+        model.Person(EX + 'author').load_work_lists()
+        self.sparql.select.side_effect = EndpointError(503, 'Service Unavailable')
+        with mock.patch('biblodui.cache.time') as clock:
+            clock.time.return_value = time.time() + model.GRAPH_CACHE_TTL + 1
+            reset_stale()
+            work_lists = person.load_work_lists()
+        # loaded on fetch threads, but flagged on this one
+        self.assertTrue(served_stale())
+        self.assertEqual(list(work_lists), ['authored', 'contributed', 'about'])
+        reset_stale()
+
+    def test_no_works(self):
+        self.sparql.select.return_value = {'results': {'bindings': [
+            {'count': {'type': 'literal', 'value': '0'}},
+        ]}}
+        works = model.WorkList(EX + 'nobody', model.SCHEMA.author)
+        self.assertEqual((works.total, works.bindings, works.pages()), (0, [], 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from rdflib import Graph, URIRef, BNode, Literal, RDF
+from rdflib.compare import isomorphic
+from rdflib.namespace import XSD
+
+from biblodui.ntparser import parse_ntriples
+from biblodui.serializers import iter_ntriples
+
+EX = 'http://example.org/'
+
+
+def sample_graph():
+    graph = Graph()
+    work = URIRef(EX + 'work')
+    inst = URIRef(EX + 'inst/ä')
+    ident = BNode()
+    graph.add((work, RDF.type, URIRef(EX + 'Work')))
+    graph.add((work, URIRef(EX + 'name'), Literal('Seitsemän veljestä', lang='fi')))
+    graph.add((work, URIRef(EX + 'name'), Literal('Seven Brothers', lang='en')))
+    graph.add((work, URIRef(EX + 'note'), Literal('quote " backslash \\ tab \t newline \n end')))
+    graph.add((work, URIRef(EX + 'pages'), Literal('42', datatype=XSD.integer)))
+    graph.add((work, URIRef(EX + 'example'), inst))
+    graph.add((inst, URIRef(EX + 'identifier'), ident))
+    graph.add((ident, URIRef(EX + 'value'), Literal('\U0001F4D6')))
+    return graph
+
+
+class NTriplesTest(unittest.TestCase):
+    def test_round_trip(self):
+        graph = sample_graph()
+        data = b''.join(iter_ntriples(graph))
+        parsed = parse_ntriples(data, Graph())
+        self.assertEqual(len(parsed), len(graph))
+        self.assertTrue(isomorphic(parsed, graph))
+
+    def test_matches_rdflib_parser(self):
+        data = b''.join(iter_ntriples(sample_graph()))
+        expected = Graph().parse(data=data.decode('utf-8'), format='nt')
+        self.assertTrue(isomorphic(parse_ntriples(data, Graph()), expected))
+
+    def test_blank_nodes_are_not_shared_between_documents(self):
+        data = b'_:b0 <http://example.org/p> "x" .\n'
+        graph = Graph()
+        parse_ntriples(data, graph)
+        parse_ntriples(data, graph)
+        self.assertEqual(len(set(graph.subjects())), 2)
+
+    def test_escaped_iri(self):
+        graph = parse_ntriples(b'<http://example.org/\\u00E4> <http://example.org/p> <http://example.org/o> .\n', Graph())
+        self.assertIn(URIRef(EX + 'ä'), set(graph.subjects()))
+
+    def test_invalid_line(self):
+        with self.assertRaisesRegex(ValueError, 'line 2'):
+            parse_ntriples(b'<http://example.org/s> <http://example.org/p> "o" .\n'
+                           b'<http://example.org/s> <http://example.org/p> "o"\n', Graph())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import gzip
+import unittest
+from unittest import mock
+
+from biblodui.rendercache import RenderCache
+
+
+class RenderCacheTest(unittest.TestCase):
+    def test_stores_compressed_copies(self):
+        cache = RenderCache(max_entry_bytes=100)
+        body = b'<p>' + b'x' * 90 + b'</p>'
+        cache.put(('http://example.org/a', 'html'), 'etag', body, 'text/html')
+        entry = cache.get(('http://example.org/a', 'html'), 'etag')
+        self.assertEqual(gzip.decompress(entry.bodies['gzip']), body)
+        self.assertIsNone(cache.get(('http://example.org/a', 'html'), 'other'))
+
+    def test_large_body_is_neither_compressed_nor_stored(self):
+        cache = RenderCache(max_entry_bytes=100)
+        with mock.patch('biblodui.rendercache.gzip') as mock_gzip:
+            entry = cache.put(('http://example.org/a', 'html'), 'etag', b'x' * 101, 'text/html')
+        self.assertFalse(mock_gzip.compress.called)
+        self.assertEqual(list(entry.bodies), ['identity'])
+        self.assertIsNone(cache.get(('http://example.org/a', 'html'), 'etag'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
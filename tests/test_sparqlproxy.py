@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from biblodui import app, model, sparqlproxy
+from biblodui.diskcache import DiskGraphCache
+
+
+class ExampleResultsTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patcher = mock.patch.object(model, 'disk_cache', DiskGraphCache(os.path.join(tmpdir, 'graphs.db')))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sparqlproxy.example_cache.invalidate()
+        self.addCleanup(sparqlproxy.example_cache.invalidate)
+        self.run_query = mock.Mock(side_effect=lambda query, mimetype: b'results')
+        patcher = mock.patch.object(sparqlproxy, 'run_query', self.run_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_computed_by_one_process(self):
+        computing = sparqlproxy.ExampleResults(app.root_path)
+        loading = sparqlproxy.ExampleResults(app.root_path)
+        self.assertTrue(computing.computes())
+        self.addCleanup(computing._lock_file.close)
+        # the lock is held through another open file, as by another process
+        self.assertFalse(loading.computes())
+        queries = computing.queries()
+        self.assertTrue(queries)
+
+        self.assertEqual(loading.refresh(), len(queries))
+        self.assertEqual(computing.refresh(), 0)
+        self.assertEqual(self.run_query.call_count, len(queries))
+        sparqlproxy.example_cache.invalidate()
+        self.assertEqual(loading.refresh(), 0)
+        self.assertEqual(self.run_query.call_count, len(queries))
+        key = sparqlproxy.cache_key(*queries[0])
+        self.assertEqual(sparqlproxy.example_cache.peek(key), b'results')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from rdflib import RDF, URIRef
+from rdflib.compare import isomorphic
+
+from biblodui.ntparser import parse_ntriples
+from biblodui.serializers import iter_ntriples
+from biblodui.triplestore import GraphBuilder
+
+from tests.test_ntparser import EX, sample_graph
+
+
+class CompactGraphTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = sample_graph()
+        builder = GraphBuilder()
+        for triple in self.graph:
+            builder.add(triple)
+        self.compact = builder.build()
+
+    def test_round_trip(self):
+        data = b''.join(iter_ntriples(self.graph))
+        parsed = parse_ntriples(data, GraphBuilder()).build()
+        self.assertEqual(len(parsed), len(self.graph))
+        self.assertTrue(isomorphic(parsed.to_graph(), self.graph))
+
+    def test_patterns_match_rdflib(self):
+        terms = set()
+        for triple in self.graph:
+            terms.update(triple)
+        patterns = [(None, None, None)]
+        for term in terms:
+            patterns += [(term, None, None), (None, term, None), (None, None, term)]
+        for s, p, o in self.graph:
+            patterns += [(s, p, None), (None, p, o), (s, p, o), (s, None, o)]
+        for pattern in patterns:
+            self.assertEqual(sorted(self.compact.triples(pattern)), sorted(self.graph.triples(pattern)),
+                             pattern)
+
+    def test_lookups(self):
+        work = URIRef(EX + 'work')
+        self.assertIn((work, RDF.type, URIRef(EX + 'Work')), self.compact)
+        self.assertNotIn((work, RDF.type, URIRef(EX + 'Instance')), self.compact)
+        self.assertNotIn((URIRef(EX + 'unknown'), RDF.type, URIRef(EX + 'Work')), self.compact)
+        self.assertEqual(self.compact.value(work, URIRef(EX + 'example')), URIRef(EX + 'inst/ä'))
+        self.assertEqual(self.compact.value(None, URIRef(EX + 'example'), URIRef(EX + 'inst/ä')), work)
+        self.assertIsNone(self.compact.value(work, URIRef(EX + 'unknown')))
+        self.assertEqual(set(self.compact.subjects()), set(self.graph.subjects()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+import json
+import re
+import threading
+import unittest
+from unittest import mock
+
+from rdflib import Graph, Literal, Namespace, BNode, RDF
+
+from biblodui import app, model, views, sparqlproxy, warmup
+from biblodui.cache import GraphCache
+from biblodui.endpoint import EndpointError
+from biblodui.rendercache import RenderCache
+
+SCHEMA = Namespace('http://schema.org/')
+BIB = Namespace('http://urn.fi/URN:NBN:fi:bib:me:')
+PN = Namespace('http://urn.fi/URN:NBN:fi:au:pn:')
+
+WORK = BIB.W00000000001
+INSTANCE = BIB.I00000000001
+STUDY = BIB.W00000000002 # a work about WORK
+AUTHOR = PN['000000001']
+
+
+def dataset():
+    g = Graph()
+    g.add((AUTHOR, RDF.type, SCHEMA.Person))
+    g.add((AUTHOR, SCHEMA.name, Literal('Kivi, Aleksis')))
+    g.add((WORK, RDF.type, SCHEMA.CreativeWork))
+    g.add((WORK, SCHEMA.name, Literal('Seitsemän veljestä')))
+    g.add((WORK, SCHEMA.author, AUTHOR))
+    g.add((WORK, SCHEMA.workExample, INSTANCE))
+    g.add((INSTANCE, RDF.type, SCHEMA.Book))
+    g.add((INSTANCE, SCHEMA.exampleOfWork, WORK))
+    g.add((INSTANCE, SCHEMA.datePublished, Literal('1870')))
+    ident = BNode()
+    g.add((INSTANCE, SCHEMA.identifier, ident))
+    g.add((ident, SCHEMA.value, Literal('951-1-00000-0')))
+    g.add((STUDY, RDF.type, SCHEMA.CreativeWork))
+    g.add((STUDY, SCHEMA.name, Literal('Veljesten vaiheet')))
+    g.add((STUDY, SCHEMA.author, AUTHOR))
+    g.add((STUDY, SCHEMA.about, WORK))
+    return g
+
+
+class FakeEndpoint:
+    """answers queries in process from a graph, like model.sparql"""
+
+    timeout = 20
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.queries = []
+        self.failing = None # queries containing this fail
+        self.text_hits = [] # bindings of text index queries, which rdflib can't answer
+        self._lock = threading.Lock()
+
+    def query(self, query, accept, timeout=None):
+        with self._lock:
+            self.queries.append(query)
+            if self.failing is not None and self.failing in query:
+                raise EndpointError(500, 'Internal Server Error')
+            if 'text:query' in query:
+                return json.dumps({'results': {'bindings': self.text_hits}}).encode('utf-8')
+            result = self.graph.query(query)
+        if result.type == 'CONSTRUCT':
+            return result.graph.serialize(format='nt', encoding='utf-8')
+        return result.serialize(format='json', encoding='utf-8')
+
+    def select(self, query, timeout=None):
+        return json.loads(self.query(query, 'application/sparql-results+json', timeout).decode('utf-8'))
+
+
+class ViewTestCase(unittest.TestCase):
+    def setUp(self):
+        self.endpoint = FakeEndpoint(dataset())
+        patches = [
+            mock.patch.object(model, 'sparql', self.endpoint),
+            mock.patch.object(model, 'disk_cache', None),
+            mock.patch.object(model, 'graph_cache', GraphCache()),
+            mock.patch.object(model, 'list_cache', GraphCache()),
+            mock.patch.object(model, 'instance_work_cache', GraphCache()),
+            mock.patch.object(model, 'exists_cache', GraphCache()),
+            mock.patch.object(model, 'search_cache', GraphCache()),
+            mock.patch.object(views, 'render_cache', RenderCache(1024 * 1024, 60, 1024 * 1024)),
+            # no background loads querying the endpoint
+            mock.patch.object(model.collections_data, 'refresh'),
+            mock.patch.object(model.conceptschemes_data, 'refresh'),
+            mock.patch.object(sparqlproxy.examples, 'start'),
+            mock.patch.object(warmup, 'start_background'),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = app.test_client()
+
+    def endpoint_queries(self):
+        return len(self.endpoint.queries)
+
+
+class DownloadTest(ViewTestCase):
+    def test_nt_download_is_cached(self):
+        response = self.client.get('/bib/me/W00000000001.nt')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/n-triples')
+        self.assertIn(b'<http://urn.fi/URN:NBN:fi:bib:me:I00000000001>', response.data)
+        self.assertIn('ETag', response.headers)
+        self.assertIn('Last-Modified', response.headers)
+        queries = self.endpoint_queries()
+        again = self.client.get('/bib/me/W00000000001.nt')
+        self.assertEqual(again.data, response.data)
+        self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+        self.assertEqual(self.endpoint_queries(), queries)
+
+    def test_nt_and_ttl_share_the_download_graph(self):
+        self.client.get('/bib/me/W00000000001.nt')
+        queries = self.endpoint_queries()
+        response = self.client.get('/bib/me/W00000000001.ttl')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.endpoint_queries(), queries)
+
+    def test_unknown_resource(self):
+        response = self.client.get('/bib/me/W99999999999.nt')
+        self.assertEqual(response.status_code, 404)
+
+
+class NotFoundTest(ViewTestCase):
+    def test_missing_resource_is_only_asked_about(self):
+        for i in range(2):
+            response = self.client.get('/bib/me/W99999999999')
+            self.assertEqual(response.status_code, 404)
+        self.assertEqual(len(self.endpoint.queries), 1)
+        self.assertIn('ASK', self.endpoint.queries[0])
+
+    def test_cached_graph_is_not_asked_about(self):
+        self.client.get('/bib/me/W00000000001')
+        model.exists_cache.invalidate()
+        queries = self.endpoint_queries()
+        self.assertEqual(self.client.get('/bib/me/W00000000001').status_code, 200)
+        self.assertEqual(self.endpoint_queries(), queries)
+
+
+class ValidatorTest(ViewTestCase):
+    def test_strong_and_weak_etags(self):
+        etag = self.client.get('/bib/me/W00000000001.ttl').headers['ETag']
+        for tag in (etag, 'W/' + etag, '"other", ' + etag):
+            response = self.client.get('/bib/me/W00000000001.ttl', headers={'If-None-Match': tag})
+            self.assertEqual(response.status_code, 304, tag)
+            self.assertEqual(response.headers['ETag'], etag)
+        response = self.client.get('/bib/me/W00000000001.ttl', headers={'If-None-Match': '"other"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_of_compressed_copy(self):
+        response = self.client.get('/bib/me/W00000000001', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        response = self.client.get('/bib/me/W00000000001',
+                                   headers={'If-None-Match': 'W/' + response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_modified_since(self):
+        last_modified = self.client.get('/bib/me/W00000000001.ttl').headers['Last-Modified']
+        response = self.client.get('/bib/me/W00000000001.ttl', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_html_has_no_last_modified(self):
+        # it also depends on the work lists and the templates
+        response = self.client.get('/bib/me/W00000000001')
+        self.assertIn('ETag', response.headers)
+        self.assertNotIn('Last-Modified', response.headers)
+
+
+def statements(lines):
+    """return the set of N-Triples lines, with blank node labels replaced"""
+    return set(re.sub(r'_:\w+', '_:b', line) for line in lines if line.strip() and not line.startswith('#'))
+
+
+class ExportTest(ViewTestCase):
+    def test_same_statements_as_downloads(self):
+        paths = ['/bib/me/W00000000001', '/bib/me/W00000000002', '/au/pn/000000001']
+        response = self.client.post('/bib/export.nq', data='\n'.join(paths), content_type='text/plain')
+        self.assertEqual(response.status_code, 200)
+        graphs = {}
+        for line in response.data.decode('utf-8').splitlines():
+            triple, context = line.rsplit(' <', 1)
+            graphs.setdefault(model.uri_to_url(context[:-len('> .')]), []).append(triple + ' .')
+        self.assertEqual(sorted(graphs), sorted(paths))
+        for path in paths:
+            download = self.client.get(path + '.nt').data.decode('utf-8').splitlines()
+            self.assertEqual(statements(graphs[path]), statements(download), path)
+
+    def test_failed_chunk_is_marked(self):
+        self.endpoint.failing = 'VALUES ?resource'
+        response = self.client.post('/bib/export.nt', data='W00000000001\n/au/pn/000000001\n',
+                                    content_type='text/plain')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode('utf-8').splitlines(),
+                         ['# failed: <%s>' % WORK, '# failed: <%s>' % AUTHOR])
+
+    def test_not_found(self):
+        response = self.client.post('/bib/export.nt', data='W99999999999', content_type='text/plain')
+        self.assertEqual(response.data, b'# not found: <http://urn.fi/URN:NBN:fi:bib:me:W99999999999>\n')
+
+
+class SearchTest(ViewTestCase):
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        self.endpoint.text_hits = [
+            {'uri': {'type': 'uri', 'value': str(BIB['W%011d' % n])},
+             'score': {'type': 'literal', 'value': str(100 - n)},
+             'literal': {'type': 'literal', 'value': 'Kivi %d' % n},
+             'type': {'type': 'uri', 'value': 'http://id.loc.gov/ontologies/bibframe/Work'}}
+            for n in range(1, 26)]
+
+    def test_pages_from_one_query(self):
+        response = self.client.get('/bib/search.html?query=Kivi&count=10&startIndex=11')
+        self.assertEqual(response.status_code, 200)
+        page = response.data.decode('utf-8')
+        self.assertIn('<meta name="startIndex" content="11"/>', page)
+        self.assertIn('<meta name="totalResults" content="25"/>', page)
+        self.assertIn('Kivi 11<', page)
+        self.assertIn('Kivi 20<', page)
+        self.assertNotIn('Kivi 21<', page)
+        self.assertIn('startIndex=1">Previous', page)
+        self.assertIn('startIndex=21">Next', page)
+        self.client.get('/bib/search.html?query=kivi&count=10&startIndex=21')
+        self.assertEqual(self.endpoint_queries(), 1)
+
+    def test_start_page(self):
+        response = self.client.get('/bib/search.xml?query=kivi&count=10&startPage=3')
+        self.assertEqual(response.mimetype, 'application/rss+xml')
+        feed = response.data.decode('utf-8')
+        self.assertIn('<opensearch:startIndex>21</opensearch:startIndex>', feed)
+        self.assertEqual(feed.count('<item>'), 5)
+        self.assertIn('rel="previous"', feed)
+        self.assertNotIn('rel="next"', feed)
+
+
+class PartialGraphTest(ViewTestCase):
+    def test_page_without_optional_parts_is_cached_briefly(self):
+        # the subquery for the statements of the instances
+        self.endpoint.failing = 'NOT IN (schema:identifier'
+        response = self.client.get('/bib/me/W00000000001')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], views.STALE_CACHE_CONTROL)
+        self.assertIn('Warning', response.headers)
+        # complete once the subquery succeeds again
+        self.endpoint.failing = None
+        response = self.client.get('/bib/me/W00000000001')
+        self.assertEqual(response.headers['Cache-Control'], views.CACHE_CONTROL)
+        self.assertNotIn('Warning', response.headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from biblodui import model, warmup
+from biblodui.diskcache import DiskGraphCache
+
+
+class WarmupLockTest(unittest.TestCase):
+    def test_one_process_per_host_warms(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with mock.patch.object(model, 'disk_cache', DiskGraphCache(os.path.join(tmpdir, 'graphs.db'))):
+            first = warmup.take_lock()
+            self.assertIsNotNone(first)
+            # a lock taken through another open file, as by another process, is refused
+            self.assertIsNone(warmup.take_lock())
+            first.close()
+            second = warmup.take_lock()
+            self.assertIsNotNone(second)
+            second.close()
+
+
+if __name__ == '__main__':
+    unittest.main()